@@ -0,0 +1,156 @@
+#!/usr/bin/env -S uv run --quiet --script
+# /// script
+# requires-python = ">=3.13"
+# dependencies = [
+#   "orjson>=3.10.0",
+#   "xmltodict>=0.14.2"
+# ]
+# ///
+import argparse
+import ast
+import json
+import math
+import os
+import re
+import sys
+import time
+from collections.abc import Callable
+from typing import Any
+from xml.sax.saxutils import escape, quoteattr
+
+import xmltodict
+
+
+def error_and_exit(error_name: str, error_message: str):
+    json.dump({"name": error_name, "message": error_message}, sys.stderr, indent="\t")
+    exit(100)
+
+
+parser = argparse.ArgumentParser(description="Benchmark how fast the batch runners build a row's payload")
+parser.add_argument("--rows", type=int, default=20000)
+parser.add_argument("--edition", action='append', choices=["json", "xml"])
+parser.add_argument("--no-orjson", action='store_true')
+parser.add_argument("--json", action='store_true')
+args = parser.parse_args()
+
+flag_rows = max(args.rows, 1)
+flag_editions = args.edition or ["json", "xml"]
+flag_no_orjson = args.no_orjson
+flag_json = args.json
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# What the batch runners need to build a payload, everything else in them sends requests.
+definitions = {
+    "json": {"orjson", "finite", "json_dumps", "json_loads", "resolve_path", "PiperTemplate", "json_slot", "JsonPayloadTemplate"},
+    "xml": {"resolve_path", "PiperTemplate", "xml_slot", "xml_value", "XmlPayloadTemplate"},
+}
+
+# Mostly static, like an import payload, with a handful of slots filled from each row.
+payload = {
+    "Order": {
+        "@id": "#d!batch/id",
+        "Source": "resttoml",
+        "Customer": {"Name": "#d!batch/name", "Email": "#d!batch/email", "Tier": "standard"},
+        "Lines": {"Line": [
+            {"Sku": "#d!batch/sku", "Qty": "#d!batch/qty", "Unit": "each"},
+            {"Sku": "SHIPPING", "Qty": 1, "Unit": "each"}
+        ]},
+        "Flags": {"Gift": False, "Express": "#d!batch/express"},
+        "Note": "Imported by the payload benchmark"
+    }
+}
+
+
+def node_names(node: ast.stmt) -> set[str]:
+    match node:
+        case ast.FunctionDef(name=name) | ast.ClassDef(name=name):
+            return {name}
+        case ast.Assign(targets=targets):
+            return {target.id for target in targets if isinstance(target, ast.Name)}
+        case ast.Try(body=body):
+            return {alias.asname or alias.name for item in body if isinstance(item, ast.Import) for alias in item.names}
+    return set()
+
+
+def load_script(edition: str) -> dict:
+    """The batch runners run top to bottom as they load, so only their payload code is taken out and run here."""
+    path = os.path.join(root, edition, f"rest_toml_{edition}_batch.py")
+    try:
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+    except (OSError, SyntaxError) as e:
+        error_and_exit("BENCH_SCRIPT_ERROR", e.__str__())
+    nodes = [node for node in tree.body if node_names(node) & definitions[edition]]
+    missing = definitions[edition] - set().union(*(node_names(node) for node in nodes))
+    if missing:
+        error_and_exit("BENCH_SCRIPT_ERROR", f"{path} has no {", ".join(sorted(missing))}")
+    namespace = {
+        "json": json,
+        "math": math,
+        "re": re,
+        "xmltodict": xmltodict,
+        "escape": escape,
+        "quoteattr": quoteattr,
+        "Any": Any,
+        "Callable": Callable,
+    }
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), path, "exec"), namespace)
+    if flag_no_orjson:
+        namespace["orjson"] = None
+    return namespace
+
+
+def rows() -> list[dict]:
+    return [
+        {
+            "id": pos,
+            "name": f"Customer {pos} & Sons",
+            "email": f"customer{pos}@example.com",
+            "sku": f"SKU-{pos % 997:04d}",
+            "qty": pos % 7 + 1,
+            "express": pos % 2 == 0
+        }
+        for pos in range(flag_rows)
+    ]
+
+
+def rows_per_second(build: Callable[[Callable[[str], Any]], str], batch: list[dict]) -> float:
+    start = time.perf_counter()
+    for row in batch:
+        data = {"batch": row}
+        build(lambda path: resolve_path(data, path))
+    return len(batch) / (time.perf_counter() - start)
+
+
+results = {}
+batch = rows()
+for edition in flag_editions:
+    script = load_script(edition)
+    resolve_path = script["resolve_path"]
+    template = script["PiperTemplate"](payload)
+    if edition == "json":
+        skeleton = script["JsonPayloadTemplate"](payload)
+        before = rows_per_second(lambda get: json.dumps(template.fill(get)), batch)
+    else:
+        skeleton = script["XmlPayloadTemplate"](payload)
+        before = rows_per_second(lambda get: xmltodict.unparse(template.fill(get), pretty=True), batch)
+    after = rows_per_second(skeleton.fill, batch)
+    results[f"rest_toml_{edition}_batch"] = {
+        "rows": flag_rows,
+        "before_rows_per_second": before,
+        "after_rows_per_second": after,
+        "speedup": after / before,
+        "orjson": edition == "json" and script["orjson"] is not None
+    }
+
+if flag_json:
+    json.dump(results, sys.stdout, indent="\t")
+    exit(0)
+
+for name, result in results.items():
+    print(
+        f"{name} payload: before={result['before_rows_per_second']:.0f} rows/s"
+        f" after={result['after_rows_per_second']:.0f} rows/s ({result['speedup']:.1f}x, {result['rows']} rows"
+        f"{", orjson" if result['orjson'] else ""})"
+    )
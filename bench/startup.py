@@ -0,0 +1,109 @@
+#!/usr/bin/env -S uv run --quiet --script
+# /// script
+# requires-python = ">=3.13"
+# dependencies = []
+# ///
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def error_and_exit(error_name: str, error_message: str):
+    json.dump({"name": error_name, "message": error_message}, sys.stderr, indent="\t")
+    exit(100)
+
+
+parser = argparse.ArgumentParser(description="Benchmark cold start of RestTOML `--pipe` runs")
+parser.add_argument("--runs", type=int, default=20)
+parser.add_argument("--edition", action='append', choices=["json", "xml"])
+parser.add_argument("--python")
+parser.add_argument("--json", action='store_true')
+args = parser.parse_args()
+
+flag_runs = max(args.runs, 1)
+flag_editions = args.edition or ["json", "xml"]
+flag_python = args.python
+flag_json = args.json
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if "xml" in self.headers.get("Accept", ""):
+            body, content_type = b"<bench>ok</bench>", "application/xml"
+        else:
+            body, content_type = b'{"bench": "ok"}', "application/json"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# The scripts fall back to this address when no adapter is given, so no adapter needs installing.
+# It is fixed for the same reason, an adapter would run on every timed start.
+try:
+    server = ThreadingHTTPServer(("127.0.0.1", 18080), Handler)
+except OSError as e:
+    error_and_exit("BENCH_PORT_ERROR", e.__str__())
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def command(edition: str, toml: str) -> list[str]:
+    script = os.path.join(root, edition, f"rest_toml_{edition}.py")
+    if flag_python:
+        return [flag_python, script, toml, "--pipe"]
+    return [script, toml, "--pipe"]
+
+
+def time_runs(edition: str, toml: str) -> list[float]:
+    # One untimed run first, so uv has resolved the environment before the clock starts.
+    subprocess.run(command(edition, toml), check=True, capture_output=True)
+    timings = []
+    for _ in range(flag_runs):
+        start = time.perf_counter()
+        subprocess.run(command(edition, toml), check=True, capture_output=True)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+results = {}
+with tempfile.TemporaryDirectory() as tmp:
+    toml = os.path.join(tmp, "bench.toml")
+    with open(toml, "w") as f:
+        f.write('[http]\nendpoint = "bench"\n')
+    for edition in flag_editions:
+        try:
+            timings = time_runs(edition, toml)
+        except subprocess.CalledProcessError as e:
+            error_and_exit("BENCH_RUN_ERROR", f"{e.__str__()} {e.stderr.decode('utf-8')}")
+        results[f"rest_toml_{edition}"] = {
+            "runs": flag_runs,
+            "min_ms": min(timings),
+            "median_ms": statistics.median(timings),
+            "mean_ms": statistics.mean(timings),
+            "max_ms": max(timings)
+        }
+
+server.shutdown()
+
+if flag_json:
+    json.dump(results, sys.stdout, indent="\t")
+    exit(0)
+
+for name, result in results.items():
+    print(
+        f"{name} --pipe: min={result['min_ms']:.1f}ms median={result['median_ms']:.1f}ms"
+        f" mean={result['mean_ms']:.1f}ms max={result['max_ms']:.1f}ms ({result['runs']} runs)"
+    )
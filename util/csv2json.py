@@ -6,6 +6,7 @@
 import argparse
 import csv
 import datetime
+import itertools
 import json
 import os
 import sys
@@ -24,10 +25,12 @@ def error_and_exit(error_name: str, error_message: str):
 parser = argparse.ArgumentParser("Convert CSV to Json")
 parser.add_argument("toml")
 parser.add_argument("--indent", action='store_true')
+parser.add_argument("--ndjson", action='store_true')
 args = parser.parse_args()
 
 arg_toml = args.toml
 flag_indent = args.indent
+flag_ndjson = args.ndjson
 
 toml_data = None
 try:
@@ -201,21 +204,24 @@ def get_rows_from_csv() -> Iterator[list]:
             yield list(row)
 
 
-rows = list(get_rows_from_csv())
+rows = get_rows_from_csv()
 
 csv_header: list | None = None
 if toml_data.use_header:
-    csv_header = rows[0]
-    rows = rows[1:]
-elif toml_data.map:
-    csv_header = list(toml_data.map)
-    if len(csv_header) != len(rows[0]):
-        error_and_exit(
-            "CSV_HEADER_LENGHT",
-            "Length of CSV is not equal to row"
-        )
+    csv_header = next(rows, [])
 else:
-    csv_header = list(range(len(rows[0])))
+    # Only the first row is read ahead for its length, then put back in front of the rest.
+    first_row = next(rows, [])
+    rows = itertools.chain([first_row], rows) if first_row else rows
+    if toml_data.map:
+        csv_header = list(toml_data.map)
+        if first_row and len(csv_header) != len(first_row):
+            error_and_exit(
+                "CSV_HEADER_LENGHT",
+                "Length of CSV is not equal to row"
+            )
+    else:
+        csv_header = list(range(len(first_row)))
 
 toml_data.hint_len_check(len(csv_header))
 
@@ -225,12 +231,16 @@ def handle_csv_column(row: list) -> Iterator[tuple[str, Any]]:
         yield str(csv_header[pos]), toml_data.hint_value(pos, row[pos])
 
 
-def handle_csv_rows(rows: list) -> Iterator[dict[str, Any]]:
+def handle_csv_rows(rows: Iterator[list]) -> Iterator[dict[str, Any]]:
     for row in rows:
         yield dict(handle_csv_column(row))
 
 
-if flag_indent:
+if flag_ndjson:
+    # A row is written as soon as it is converted, so memory stays flat however big the CSV is.
+    for row in handle_csv_rows(rows):
+        sys.stdout.write(json.dumps(row) + "\n")
+elif flag_indent:
     json.dump({"batch": list(handle_csv_rows(rows))}, sys.stdout, indent="\t")
 else:
     json.dump({"batch": list(handle_csv_rows(rows))}, sys.stdout)
\ No newline at end of file
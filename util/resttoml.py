@@ -0,0 +1,262 @@
+#!/usr/bin/env -S uv run --quiet --script
+# /// script
+# requires-python = ">=3.13"
+# dependencies = [
+#   "requests>=2.32.3",
+#   "urllib3[brotli,zstd]>=2.2.0",
+#   "zstandard>=0.23.0",
+#   "ijson>=3.3.0",
+#   "rich>=13.9.4",
+#   "xmltodict>=0.14.2"
+# ]
+# ///
+import argparse
+import io
+import json
+import os
+import shlex
+import signal
+import socket
+import sys
+import tempfile
+from types import CodeType
+
+
+def error_and_exit(error_name: str, error_message: str):
+    json.dump({"name": error_name, "message": error_message}, sys.stderr, indent="\t")
+    exit(100)
+
+
+def default_socket() -> str:
+    if "RESTTOML_SOCKET" in os.environ:
+        return os.environ["RESTTOML_SOCKET"]
+    if "XDG_RUNTIME_DIR" in os.environ:
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], f"resttoml-{os.getuid()}.sock")
+    # The temp dir is shared, the socket goes in a directory only its user can enter.
+    return os.path.join(tempfile.gettempdir(), f"resttoml-{os.getuid()}", "resttoml.sock")
+
+
+parser = argparse.ArgumentParser(description="Resident RestTOML server and its client")
+parser.add_argument("--socket", default=default_socket())
+subparsers = parser.add_subparsers(dest="command", required=True)
+
+parser_serve = subparsers.add_parser("serve", help="Keep an interpreter with RestTOML loaded, listening on --socket")
+
+parser_run = subparsers.add_parser("run", help="Run a RestTOML file through the server, or directly if it isn't up")
+parser_run.add_argument("--edition", choices=["json", "xml"])
+parser_run.add_argument("toml")
+parser_run.add_argument("args", nargs=argparse.REMAINDER)
+
+args = parser.parse_args()
+
+flag_socket = args.socket
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+scripts = {
+    "json": os.path.join(root, "json", "rest_toml_json.py"),
+    "xml": os.path.join(root, "xml", "rest_toml_xml.py"),
+}
+
+
+class ShebangError(Exception): pass
+
+
+def read_shebang(toml: str, edition: str | None) -> tuple[str, list[str]]:
+    """Work out the edition and the flags from the TOML file's shebang, the way the kernel would."""
+    with open(toml) as f:
+        line = f.readline()
+    if line.startswith("#!"):
+        words = shlex.split(line[2:])
+        for pos in range(len(words)):
+            name = os.path.basename(words[pos])
+            if name in ("rest_toml_json", "rest_toml_xml"):
+                return edition or name.removeprefix("rest_toml_"), words[pos + 1:]
+    if edition:
+        return edition, []
+    raise ShebangError(f"'{toml}' has no rest_toml_json or rest_toml_xml shebang, use '--edition'")
+
+
+def recv_all(conn: socket.socket) -> bytes:
+    chunks = []
+    while chunk := conn.recv(65536):
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+code_cache: dict[str, tuple[float, CodeType]] = {}
+
+
+def compiled(script: str) -> CodeType:
+    mtime = os.path.getmtime(script)
+    if script not in code_cache or code_cache[script][0] != mtime:
+        with open(script, "rb") as f:
+            code_cache[script] = (mtime, compile(f.read(), script, "exec"))
+    return code_cache[script][1]
+
+
+def run_script(request: dict, code: CodeType) -> int:
+    try:
+        exec(code, {"__name__": "__main__", "__file__": request["script"], "__builtins__": __builtins__})
+    except SystemExit as e:
+        match e.code:
+            case None:
+                return 0
+            case int():
+                return e.code
+            case _:
+                sys.stderr.write(f"{e.code}\n")
+                return 1
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def read_request(conn: socket.socket) -> dict:
+    # A client that never finishes sending only holds up its own child.
+    conn.settimeout(30)
+    request = json.loads(recv_all(conn))
+    conn.settimeout(None)
+    match request:
+        case {"script": str(), "argv": list(argv), "cwd": str(), "env": dict()} if all(type(arg) is str for arg in argv):
+            pass
+        case _:
+            raise TypeError("a request is an object with 'script', 'argv' (strings), 'cwd' and 'env'")
+    if request["script"] not in scripts.values():
+        raise KeyError(f"'{request["script"]}' is not a RestTOML script")
+    return request
+
+
+def execute(conn: socket.socket):
+    """Runs in the forked child, the script gets a fresh `__main__` but every module is already imported.
+
+    The request is read here too, so a slow or broken client never holds up the server's loop.
+    Whatever happens, the child ends here with `os._exit`, it must never return into that loop.
+    """
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        sys.stdin = open(os.devnull)
+        sys.stdout = io.StringIO()
+        sys.stderr = io.StringIO()
+        try:
+            request = read_request(conn)
+            code = compiled(request["script"])
+            os.environ.clear()
+            os.environ.update(request["env"])
+            os.chdir(request["cwd"])
+            sys.argv = [request["script"]] + request["argv"]
+        except (json.JSONDecodeError, UnicodeDecodeError, KeyError, TypeError, ValueError, SyntaxError, OSError) as e:
+            json.dump({"name": "DAEMON_REQUEST_ERROR", "message": e.__str__()}, sys.stderr, indent="\t")
+            exit_code = 100
+        else:
+            exit_code = run_script(request, code)
+        conn.sendall(json.dumps({
+            "code": exit_code,
+            "stdout": sys.stdout.getvalue(),
+            "stderr": sys.stderr.getvalue()
+        }).encode("utf-8"))
+        conn.close()
+    finally:
+        os._exit(0)
+
+
+def serve():
+    # Everything the scripts import is loaded once here, forked children start with it in memory.
+    import requests
+    import requests.adapters
+    import urllib3
+    import xmltodict
+    import rich
+    import rich.console
+    import rich.pretty
+    import rich.syntax
+    for script in scripts.values():
+        compiled(script)
+
+    os.umask(0o077)
+    try:
+        os.makedirs(os.path.dirname(flag_socket), mode=0o700, exist_ok=True)
+    except OSError as e:
+        error_and_exit("DAEMON_SOCKET_ERROR", e.__str__())
+    if os.path.exists(flag_socket):
+        os.unlink(flag_socket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(flag_socket)
+    server.listen()
+    # Children are never waited on, let the kernel reap them.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    # Exit through the `finally` below on a plain `kill` too, so the socket file is removed.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Listening on {flag_socket}", file=sys.stderr)
+    try:
+        while True:
+            conn, _ = server.accept()
+            # Recompile edited scripts here, so every later child inherits the fresh code.
+            for script in scripts.values():
+                try:
+                    compiled(script)
+                except (OSError, SyntaxError):
+                    code_cache.pop(script, None)
+            if os.fork() == 0:
+                server.close()
+                execute(conn)
+            conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(flag_socket)
+
+
+def run():
+    toml = os.path.abspath(args.toml)
+    try:
+        edition, shebang_args = read_shebang(toml, args.edition)
+    except ShebangError as e:
+        error_and_exit("DAEMON_SHEBANG_ERROR", e.__str__())
+    except OSError as e:
+        error_and_exit("OS_ERROR", e.__str__())
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # The environment goes to whoever listens, only a socket this user created is trusted with it.
+        if os.stat(flag_socket).st_uid != os.getuid():
+            raise PermissionError(f"'{flag_socket}' belongs to another user")
+        client.connect(flag_socket)
+    except OSError:
+        # No server of ours, run the script the same way its shebang would.
+        client.close()
+        os.execv(sys.executable, [sys.executable, scripts[edition]] + shebang_args + [toml] + args.args)
+
+    env = dict(os.environ)
+    if sys.stdout.isatty():
+        env.setdefault("FORCE_COLOR", "1")
+        env.setdefault("COLUMNS", str(os.get_terminal_size().columns))
+    client.sendall(json.dumps({
+        "script": scripts[edition],
+        "argv": shebang_args + [toml] + args.args,
+        "cwd": os.getcwd(),
+        "env": env
+    }).encode("utf-8"))
+    client.shutdown(socket.SHUT_WR)
+    try:
+        response = json.loads(recv_all(client))
+    except json.JSONDecodeError as e:
+        # A child that died before answering closes the connection with nothing sent.
+        error_and_exit("DAEMON_RESPONSE_ERROR", f"the server sent no usable response: {e}")
+    except OSError as e:
+        error_and_exit("DAEMON_RESPONSE_ERROR", e.__str__())
+    finally:
+        client.close()
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    exit(response["code"])
+
+
+match args.command:
+    case "serve":
+        serve()
+    case "run":
+        run()
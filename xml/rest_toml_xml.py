@@ -3,35 +3,57 @@
 # requires-python = ">=3.13"
 # dependencies = [
 #   "requests>=2.32.3",
+#   "urllib3[brotli,zstd]>=2.2.0",
+#   "zstandard>=0.23.0",
 #   "rich>=13.9.4",
 #   "xmltodict>=0.14.2"
 # ]
 # ///
 import argparse
+import base64
+import fcntl
+import gzip
+import hashlib
 import json
+import math
 import os
+import re
+import shlex
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import tomllib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from http import cookies
 from dataclasses import dataclass, field
+from datetime import timedelta
 from xml.parsers.expat import ExpatError
 from typing import Self, Any
-from collections.abc import Iterator, MutableMapping
+from collections.abc import Callable, Iterator, Mapping
 
-import requests
-import urllib3
-import xmltodict
-from rich.pretty import pprint
-from rich.console import Console
-from rich.syntax import Syntax
+
+# Holds the pipe's command while a `.toml` pipe runs in this process, see `run_toml_pipe()`.
+nested_run = threading.local()
 
 
 def error_and_exit(error_name: str, error_message: str):
-    json.dump({"name": error_name, "message": error_message}, sys.stderr, indent="\t")
+    error = {"name": error_name, "message": error_message}
+    if getattr(nested_run, "cmd", None):
+        # Fail only the pipe, the same way a pipe run as a subprocess exits with 100.
+        raise subprocess.CalledProcessError(100, nested_run.cmd, stderr=json.dumps(error, indent="\t").encode("utf-8"))
+    json.dump(error, sys.stderr, indent="\t")
     exit(100)
 
 
+def size_type(value: str) -> int:
+    units = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30}
+    if value[-1:].lower() in units:
+        return int(float(value[:-1]) * units[value[-1:].lower()])
+    return int(value)
+
+
 parser = argparse.ArgumentParser(description="Process HTTP Rest request for XML")
 
 parser.add_argument("toml")
@@ -41,8 +63,18 @@ parser.add_argument("--show-header", action='store_true')
 parser.add_argument("--pipe", action='store_true')
 parser.add_argument("--indent", action='store_true')
 parser.add_argument("--arg", action='append')
+parser.add_argument("--load")
+parser.add_argument("--show-plan", action='store_true')
+parser.add_argument("--no-cache", action='store_true')
+parser.add_argument("--stream", action='store_true')
+parser.add_argument("--output")
+parser.add_argument("--item-depth", type=int)
+parser.add_argument("--max-body", type=size_type)
+parser.add_argument("--max-display", type=size_type)
 
 args = parser.parse_args()
+# Parsed again for `.toml` pipes, where bad flags fall back to a subprocess instead of exiting.
+parser.exit_on_error = False
 
 arg_toml = args.toml
 flag_adapter = args.adapter
@@ -51,9 +83,21 @@ flag_show_header = args.show_header
 flag_pipe = args.pipe
 flag_args = args.arg
 flag_indent = args.indent
+flag_load = args.load
+flag_show_plan = args.show_plan
+flag_no_cache = args.no_cache
+flag_stream = args.stream
+# Resolved now, the working directory moves to the TOML file's folder further down.
+flag_output = os.path.abspath(args.output) if args.output else None
+flag_item_depth = args.item_depth
+flag_max_body = args.max_body
+flag_max_display = args.max_display
+
+if flag_item_depth is not None and flag_item_depth < 1:
+    error_and_exit("ITEM_DEPTH_ERROR", "'--item-depth' must be 1 or more")
 
 
-def process_flag_args(data_type: dict) -> dict:
+def process_flag_args(data_type: dict, flag_args: list[str] | None) -> dict:
     arg_dict = {}
     if not flag_args:
         return arg_dict
@@ -88,14 +132,64 @@ def process_flag_args(data_type: dict) -> dict:
     return arg_dict
 
 
-def arg_pass() -> Iterator[str]:
-    for arg in flag_args:
+def arg_pass(flag_args: list[str] | None) -> Iterator[str]:
+    for arg in flag_args or []:
         yield "--arg"
         yield str(arg)
 
 
+class DiskCache:
+    """A JSON entry on disk that expires, one file per key under `directory`, readable by the user only.
+
+    The entry is locked for the whole `with` block, so concurrent runs wait for the one refreshing it instead of all doing so.
+    """
+    __directory: str
+    __path: str
+    __lock: int | None
+
+    def __init__(self, directory: str, key: list):
+        self.__directory = directory
+        self.__path = os.path.join(directory, f"{hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()}.json")
+        self.__lock = None
+
+    def __enter__(self) -> Self:
+        try:
+            os.makedirs(self.__directory, mode=0o700, exist_ok=True)
+            self.__lock = os.open(f"{self.__path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self.__lock, fcntl.LOCK_EX)
+        except OSError as e:
+            error_and_exit("CACHE_ERROR", e.__str__())
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.__lock is not None:
+            os.close(self.__lock)
+
+    def load(self) -> tuple[bool, Any]:
+        try:
+            with open(self.__path, "rb") as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return False, None
+        match entry:
+            case {"expires": int() | float() as expires, "data": data} if expires > time.time():
+                return True, data
+            case _:
+                return False, None
+
+    def store(self, data: Any, ttl: float):
+        # Written next to the entry and renamed over it, a reader never sees half a file.
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.__directory, prefix=".tmp-")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"expires": time.time() + ttl, "data": data}, f)
+            os.replace(tmp_path, self.__path)
+        except OSError as e:
+            error_and_exit("CACHE_ERROR", e.__str__())
+
+
 # https://github.com/CJ-Jackson/AnimalApiTestServer
-adapter_data = {
+default_adapter_data = {
     "url": "http://127.0.0.1:18080",
     "headers": {
         "Content-Type": "application/xml; charset=utf-8",
@@ -104,17 +198,6 @@ adapter_data = {
     "verify": False,
 }
 
-if flag_adapter:
-    try:
-        adapter_data = subprocess.run([
-            os.path.expanduser(f"~/.config/resttoml/xml/{flag_adapter}")
-        ], check=True, capture_output=True).stdout.decode('utf-8')
-        adapter_data = json.loads(adapter_data)
-    except subprocess.CalledProcessError as e:
-        error_and_exit("FLAG_ADAPTER_ERROR", e.__str__())
-    except json.JSONDecodeError as e:
-        error_and_exit("FLAG_ADAPTER_JSON_ERROR", e.__str__())
-
 
 class AdapterDataError(Exception): pass
 
@@ -124,6 +207,14 @@ class AdapterData():
     url: str
     headers: dict[str, str]
     verify: bool = True
+    pool_connections: int = 10
+    # None leaves the pool size to the runner.
+    pool_maxsize: int | None = None
+    pool_block: bool = False
+    connect_timeout: float | None = None
+    read_timeout: float | None = None
+    max_retries: int = 0
+    keep_alive: bool = True
 
     @classmethod
     def create(cls, data: dict):
@@ -132,30 +223,85 @@ class AdapterData():
                 pass
             case _:
                 raise AdapterDataError("Adapter must have 'url'(str) and 'headers'(dict)")
+        for name, minimum in (("pool_connections", 1), ("pool_maxsize", 1), ("max_retries", 0)):
+            if name in data and (type(data[name]) is not int or data[name] < minimum):
+                raise AdapterDataError(f"'{name}' must be an integer of at least {minimum}")
+        for name in ("connect_timeout", "read_timeout"):
+            if name in data and (type(data[name]) not in (int, float) or data[name] <= 0):
+                raise AdapterDataError(f"'{name}' must be a positive number of seconds")
+        for name in ("pool_block", "keep_alive"):
+            if name in data and type(data[name]) is not bool:
+                raise AdapterDataError(f"'{name}' must be a bool")
         return cls(
             url=data["url"],
             headers=data["headers"],
-            verify=data.get("verify", True)
+            verify=data.get("verify", True),
+            pool_connections=data.get("pool_connections", 10),
+            pool_maxsize=data.get("pool_maxsize", None),
+            pool_block=data.get("pool_block", False),
+            connect_timeout=data.get("connect_timeout", None),
+            read_timeout=data.get("read_timeout", None),
+            max_retries=data.get("max_retries", 0),
+            keep_alive=data.get("keep_alive", True)
         )
 
+    def timeout(self) -> tuple[float | None, float | None]:
+        return self.connect_timeout, self.read_timeout
 
-try:
-    adapter_data = AdapterData.create(adapter_data)
-except AdapterDataError as e:
-    error_and_exit("ADAPTER_DATA_ERROR", e.__str__())
 
-toml_data = None
-try:
-    with open(arg_toml, "rb") as f:
-        toml_data = tomllib.load(f)
-except tomllib.TOMLDecodeError as e:
-    error_and_exit("TOML_DECODE_ERROR", e.__str__())
-except OSError as e:
-    error_and_exit("OS_ERROR", e.__str__())
-if not toml_data:
-    exit(0)
+adapter_cache_dir = os.path.expanduser("~/.cache/resttoml/adapter/xml")
 
-os.chdir(os.path.dirname(os.path.abspath(arg_toml)))
+
+def adapter_ttl(data: Any) -> float | None:
+    """How long the adapter output may be reused, `cache_ttl` as is or `expires_in` of a token a little early."""
+    match data:
+        case {"cache_ttl": int() | float() as cache_ttl} if cache_ttl > 0:
+            return cache_ttl
+        case {"expires_in": int() | float() as expires_in} if expires_in > 30:
+            return expires_in - 30
+        case _:
+            return None
+
+
+def run_adapter(path: str) -> Any:
+    try:
+        adapter_data = subprocess.run([path], check=True, capture_output=True).stdout.decode('utf-8')
+        return json.loads(adapter_data)
+    except subprocess.CalledProcessError as e:
+        error_and_exit("FLAG_ADAPTER_ERROR", e.__str__())
+    except json.JSONDecodeError as e:
+        error_and_exit("FLAG_ADAPTER_JSON_ERROR", e.__str__())
+
+
+def fetch_adapter(name: str, use_cache: bool) -> Any:
+    """Output of the adapter script, reused for as long as it says through `cache_ttl` or `expires_in`."""
+    path = os.path.expanduser(f"~/.config/resttoml/xml/{name}")
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        use_cache = False
+    if not use_cache:
+        return run_adapter(path)
+    with DiskCache(adapter_cache_dir, [path]) as cache:
+        match cache.load():
+            # An edited adapter script is run again, whatever its last output said.
+            case True, {"mtime": cached_mtime, "adapter": adapter_data} if cached_mtime == mtime:
+                return adapter_data
+        adapter_data = run_adapter(path)
+        ttl = adapter_ttl(adapter_data)
+        if ttl:
+            cache.store({"mtime": mtime, "adapter": adapter_data}, ttl)
+        return adapter_data
+
+
+def load_adapter(name: str | None, use_cache: bool) -> AdapterData:
+    adapter_data = default_adapter_data
+    if name:
+        adapter_data = fetch_adapter(name, use_cache)
+    try:
+        return AdapterData.create(adapter_data)
+    except AdapterDataError as e:
+        error_and_exit("ADAPTER_DATA_ERROR", e.__str__())
 
 
 class HttpDataError(Exception): pass
@@ -169,6 +315,9 @@ class HttpData():
     cookies: dict[str, str] = field(default_factory=dict[str, str])
     payload: dict[str, Any] | str = field(default_factory=dict[str, Any])
     method: str = "GET"
+    cache: bool = False
+    compress: str | None = None
+    stream: bool = False
 
     @classmethod
     def create(cls, data: dict) -> Self:
@@ -177,6 +326,12 @@ class HttpData():
                 pass
             case _:
                 raise HttpDataError("Must have 'endpoint'(str)")
+        if type(data.get("cache", False)) is not bool:
+            raise HttpDataError("'cache' must be a bool")
+        if data.get("compress", None) not in (None, "gzip", "zstd"):
+            raise HttpDataError("'compress' must be \"gzip\" or \"zstd\"")
+        if type(data.get("stream", False)) is not bool:
+            raise HttpDataError("'stream' must be a bool")
 
         return cls(
             endpoint=data["endpoint"],
@@ -185,6 +340,9 @@ class HttpData():
             cookies=data.get("cookies", {}),
             payload=data.get("payload", {}),
             method=data.get("method", "GET").strip().upper(),
+            cache=data.get("cache", False),
+            compress=data.get("compress", None),
+            stream=data.get("stream", False),
         )
 
 
@@ -192,12 +350,24 @@ class HttpData():
 class PipeDataError(Exception): pass
 
 
+def split_pipe_arg(arg: str) -> tuple[str, str | None]:
+    """Split a pipe arg into its literal prefix and `#d!` path, the slot is either the whole arg or `name=#d!path`."""
+    if arg.startswith("#d!"):
+        return "", arg[3:].strip("/")
+    name, sep, value = arg.partition("=")
+    if sep and value.startswith("#d!"):
+        return name + sep, value[3:].strip("/")
+    return arg, None
+
+
 @dataclass(frozen=True)
 class PipeData():
     script: str
     arg: tuple = ()
     pass_pipe_flag: bool = True
     pass_arg: bool = False
+    needs: tuple = ()
+    cache_ttl: float | None = None
 
     @classmethod
     def create(cls, data: dict) -> Self:
@@ -206,11 +376,21 @@ class PipeData():
                 pass
             case _:
                 raise PipeDataError("Must have 'script'(str)")
+        match data.get("needs", []):
+            case list() as needs if all(type(need) is str for need in needs):
+                pass
+            case _:
+                raise PipeDataError("'needs' must be a list of pipe names")
+        cache_ttl = data.get("cache_ttl", None)
+        if cache_ttl is not None and (type(cache_ttl) not in (int, float) or cache_ttl <= 0):
+            raise PipeDataError("'cache_ttl' must be a positive number of seconds")
         return cls(
             script=data["script"],
-            arg=tuple(data.get("arg", [])),
+            arg=tuple(str(arg) for arg in data.get("arg", [])),
             pass_pipe_flag=data.get("pass_pipe_flag", True),
-            pass_arg=data.get("pass_arg", False)
+            pass_arg=data.get("pass_arg", False),
+            needs=tuple(data["needs"]) if "needs" in data else (),
+            cache_ttl=cache_ttl
         )
 
 
@@ -236,6 +416,14 @@ class TomlData():
             pipe = data["pipe"]
             for key, value in pipe.items():
                 pipe[key] = PipeData.create(value)
+            for key, value in pipe.items():
+                for need in value.needs:
+                    if need not in pipe:
+                        raise PipeDataError(f"'{key}' needs unknown pipe '{need}'")
+                for _, path in map(split_pipe_arg, value.arg):
+                    # The output of a pipe is only there once it has run, so it has to be waited on.
+                    if path and path.startswith("pipe/") and path.split("/")[1] not in value.needs:
+                        raise PipeDataError(f"'{key}' uses '#d!{path}' but doesn't have '{path.split("/")[1]}' in 'needs'")
 
         return cls(
             http=HttpData.create(data["http"]),
@@ -244,105 +432,377 @@ class TomlData():
         )
 
 
-try:
-    toml_data = TomlData.create(toml_data)
-except HttpDataError as e:
-    error_and_exit("HTTP_DATA_ERROR", e.__str__())
-except TomlDataError as e:
-    error_and_exit("TOML_DATA_ERROR", e.__str__())
-except PipeDataError as e:
-    error_and_exit("PIPE_DATA_ERROR", e.__str__())
+class PipeCycleError(Exception): pass
 
 
-def _list_to_dict(v: list) -> Iterator[tuple[str, Any]]:
-    yield "_", tuple(v)
-    for i in range(len(v)):
-        yield str(i), v[i]
+def pipe_stages(pipes: dict[str, PipeData]) -> list[list[str]]:
+    """Group the pipes into stages, a pipe only needs pipes from the stages before its own."""
+    stages = []
+    done = set()
+    waiting = dict(pipes)
+    while waiting:
+        stage = [key for key, pipe in waiting.items() if done.issuperset(pipe.needs)]
+        if not stage:
+            raise PipeCycleError(f"'needs' of {", ".join(f"'{key}'" for key in waiting)} go round in a cycle")
+        for key in stage:
+            del waiting[key]
+        done.update(stage)
+        stages.append(stage)
+    return stages
 
 
-def _flatten_dict_gen(d, parent_key, sep) -> Iterator[tuple[str, Any]]:
-    for k, v in d.items():
-        if type(v) is list:
-            v = dict(_list_to_dict(v))
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, MutableMapping):
-            yield from flatten_dict(v, new_key, sep=sep).items()
-        else:
-            yield new_key, v
+def load_toml(path: str) -> TomlData | None:
+    toml_data = None
+    try:
+        with open(path, "rb") as f:
+            toml_data = tomllib.load(f)
+    except tomllib.TOMLDecodeError as e:
+        error_and_exit("TOML_DECODE_ERROR", e.__str__())
+    except OSError as e:
+        error_and_exit("OS_ERROR", e.__str__())
+    if not toml_data:
+        return None
+
+    try:
+        toml_data = TomlData.create(toml_data)
+    except HttpDataError as e:
+        error_and_exit("HTTP_DATA_ERROR", e.__str__())
+    except TomlDataError as e:
+        error_and_exit("TOML_DATA_ERROR", e.__str__())
+    except PipeDataError as e:
+        error_and_exit("PIPE_DATA_ERROR", e.__str__())
+
+    if toml_data.pipe:
+        try:
+            pipe_stages(toml_data.pipe)
+        except PipeCycleError as e:
+            error_and_exit("PIPE_CYCLE_ERROR", e.__str__())
+    return toml_data
+
+
+adapter_data = load_adapter(flag_adapter, not flag_no_cache)
+toml_data = load_toml(arg_toml)
+if not toml_data:
+    exit(0)
+
+os.chdir(os.path.dirname(os.path.abspath(arg_toml)))
+
+pipe_plan = pipe_stages(toml_data.pipe) if toml_data.pipe else []
+
+if flag_show_plan:
+    if flag_pipe:
+        json.dump({"stages": pipe_plan}, sys.stdout)
+    else:
+        for number, stage in enumerate(pipe_plan, start=1):
+            print(f"Stage {number}:")
+            for key in stage:
+                pipe = toml_data.pipe[key]
+                needs = f" (needs {", ".join(pipe.needs)})" if pipe.needs else ""
+                cached = f" (cached {pipe.cache_ttl:g}s)" if pipe.cache_ttl else ""
+                print(f"  {key}: {" ".join([pipe.script] + list(pipe.arg))}{needs}{cached}")
+    exit(0)
 
+class LoadSpecError(Exception): pass
+
+
+def parse_duration(value: str) -> float:
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    for unit in sorted(units, key=len, reverse=True):
+        if value.endswith(unit):
+            return float(value[:-len(unit)]) * units[unit]
+    return float(value)
+
+
+@dataclass(frozen=True)
+class LoadSpec():
+    duration: float
+    rps: float | None = None
+    concurrency: int = 1
 
-def flatten_dict(d: MutableMapping, parent_key: str = '', sep: str = '/') -> dict:
-    return dict(_flatten_dict_gen(d, parent_key, sep))
+    @classmethod
+    def create(cls, value: str) -> Self:
+        options = {}
+        for option in value.split(","):
+            key, sep, option_value = option.partition("=")
+            if not sep:
+                raise LoadSpecError(f"'{option}' must be 'key=value'")
+            options[key.strip()] = option_value.strip()
+        unknown = set(options) - {"rps", "concurrency", "duration"}
+        if unknown:
+            raise LoadSpecError(f"Unknown option(s) {", ".join(sorted(unknown))}, use 'rps', 'concurrency' and 'duration'")
+        try:
+            rps = float(options["rps"]) if "rps" in options else None
+            # At a fixed rate the workers only cap how many requests may be in flight at once.
+            concurrency = int(options.get("concurrency", 64 if rps else 1))
+            duration = parse_duration(options.get("duration", "10s"))
+        except ValueError as e:
+            raise LoadSpecError(e.__str__())
+        if (rps is not None and rps <= 0) or concurrency < 1 or duration <= 0:
+            raise LoadSpecError("'rps', 'concurrency' and 'duration' must be positive")
+        return cls(duration=duration, rps=rps, concurrency=concurrency)
+
+
+load_spec: LoadSpec | None = None
+if flag_load:
+    try:
+        load_spec = LoadSpec.create(flag_load)
+    except LoadSpecError as e:
+        error_and_exit("LOAD_SPEC_ERROR", e.__str__())
+
+
+
+def resolve_path(data: dict | list, path: str) -> Any:
+    """Look up a `#d!` path in the nested data.
+
+    Lists are stepped into by index, or `_` for the whole list as a tuple.
+    Only leaves can be looked up, a path ending on a dict or a list raises `KeyError` like a missing key.
+    """
+    value: Any = data
+    try:
+        for key in path.split("/"):
+            match value:
+                case dict():
+                    value = value[key]
+                case list() if key == "_":
+                    value = tuple(value)
+                case list():
+                    value = value[int(key)]
+                case _:
+                    raise KeyError(path)
+    except (KeyError, IndexError, ValueError):
+        raise KeyError(path)
+    if type(value) is dict or type(value) is list:
+        raise KeyError(path)
+    return value
+
+
+class PiperTemplate:
+    """A template walked once up front, so processing a row only fills in its `#d!` slots."""
+    __value: Any
+    __fill: Callable[[Callable[[str], Any]], Any] | None
+
+    def __init__(self, user_data: Any):
+        self.__value = user_data
+        self.__fill = self.__compile(user_data)
+
+    def fill(self, get: Callable[[str], Any]) -> Any:
+        if self.__fill is None:
+            return self.__value
+        return self.__fill(get)
+
+    def __compile(self, value: Any) -> Callable[[Callable[[str], Any]], Any] | None:
+        # Returns None for a subtree without slots, it is then reused as is for every row.
+        match value:
+            case str() if value.startswith("#d!"):
+                path = value[3:].strip('/')
+                return lambda get: get(path)
+            case dict():
+                parts = tuple((key, self.__compile(item), item) for key, item in value.items())
+                if all(fill is None for _, fill, _ in parts):
+                    return None
+                return lambda get: {key: item if fill is None else fill(get) for key, fill, item in parts}
+            case list():
+                parts = tuple((self.__compile(item), item) for item in value)
+                if all(fill is None for fill, _ in parts):
+                    return None
+                return lambda get: [item if fill is None else fill(get) for fill, item in parts]
+            case _:
+                return None
 
 
 class Piper:
     __data: dict
+    __cache: dict[str, Any]
 
     def __init__(self, data: dict):
-        self.__data = flatten_dict(data)
+        self.__data = data
+        self.__cache = {}
 
-    def process(self, user_data: dict | list) -> dict | list | None:
+    def process(self, user_data: PiperTemplate | dict | list) -> Any:
+        if not isinstance(user_data, PiperTemplate):
+            user_data = PiperTemplate(user_data)
         try:
-            if type(user_data) is dict:
-                return dict(self.__process_dict(user_data))
-            elif type(user_data) is list:
-                return list(self.__process_list(user_data))
+            return user_data.fill(self.__get)
         except KeyError as ex:
             error_and_exit(
                 "PIPER_KEY_ERROR",
                 f"'#d!{ex.__str__().strip("'")}' not found"
             )
 
-    def __process_list(self, user_data: list) -> Iterator[Any]:
-        for i in range(len(user_data)):
-            match user_data[i]:
-                case str() if str(user_data[i]).startswith("#d!"):
-                    yield self.__data[str(user_data[i])[3:].strip('/')]
-                case dict():
-                    yield dict(self.__process_dict(user_data[i]))
-                case list():
-                    yield list(self.__process_list(user_data[i]))
-                case _:
-                    yield user_data[i]
-
-    def __process_dict(self, user_data: dict) -> Iterator[tuple[str, Any]]:
-        for key, value in user_data.items():
-            match value:
-                case str() if str(value).startswith("#d!"):
-                    yield key, self.__data[str(value)[3:].strip('/')]
-                case dict():
-                    yield key, dict(self.__process_dict(value))
-                case list():
-                    yield key, list(self.__process_list(value))
-                case _:
-                    yield key, value
+    def __get(self, path: str) -> Any:
+        # Paths are only resolved when a template asks for them, large pipe output is never walked as a whole.
+        if path not in self.__cache:
+            self.__cache[path] = resolve_path(self.__data, path)
+        return self.__cache[path]
 
 
-arg_dict = process_flag_args(toml_data.arg)
-piper = Piper({"arg": arg_dict})
-if toml_data.pipe:
+def process_pipe_arg(pipe: PipeData, piper: Piper) -> list[str]:
+    pipe_arg = []
+    for arg in pipe.arg:
+        prefix, path = split_pipe_arg(arg)
+        if path is None:
+            pipe_arg.append(arg)
+        else:
+            pipe_arg.append(prefix + str(piper.process(["#d!" + path])[0]))
+    return pipe_arg
+
+
+def pipe_command(pipe: PipeData, piper: Piper, pass_args: list[str]) -> list[str]:
+    extra = []
+    if pipe.pass_pipe_flag:
+        extra += ["--pipe"]
+    extra += process_pipe_arg(pipe, piper)
+    if pipe.pass_arg:
+        extra += pass_args
+    return [pipe.script] + extra
+
+
+def toml_pipe_args(cmd: list[str], base_dir: str) -> argparse.Namespace | None:
+    """The flags a `.toml` pipe would run with, when it can run in this process instead of as a subprocess.
+
+    That is a file path ending in `.toml` with a `rest_toml_xml` shebang, run with `--pipe`
+    and without flags that change what it prints, `--item-depth` prints a line per item.
+    """
+    script = cmd[0]
+    if "/" not in script or not script.endswith(".toml"):
+        return None
+    script = os.path.join(base_dir, script)
+    try:
+        with open(script) as f:
+            line = f.readline()
+        words = shlex.split(line[2:]) if line.startswith("#!") else []
+    except (OSError, ValueError):
+        return None
+    for pos, word in enumerate(words):
+        if os.path.basename(word) != "rest_toml_xml":
+            continue
+        try:
+            toml_args, unknown = parser.parse_known_args(words[pos + 1:] + [script] + cmd[1:])
+        except argparse.ArgumentError:
+            return None
+        if unknown or not toml_args.pipe or toml_args.load or toml_args.show_plan or toml_args.item_depth:
+            return None
+        if toml_args.output:
+            toml_args.output = os.path.join(base_dir, toml_args.output)
+        return toml_args
+    return None
+
+
+def finish_pipe(process: subprocess.Popen) -> Any:
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args, stdout, stderr)
+    return json.loads(stdout.decode('utf-8').strip())
+
+
+def run_toml_pipe(cmd: list[str], toml_args: argparse.Namespace) -> Any:
+    """Run a nested request the way `--pipe` would, on the shared session and without the JSON round trip."""
+    nested_run.cmd = cmd
+    try:
+        adapter_data = load_adapter(toml_args.adapter, not toml_args.no_cache)
+        toml_data = load_toml(toml_args.toml)
+        if not toml_data:
+            # The subprocess would have printed nothing at all.
+            raise json.JSONDecodeError("Expecting value", "", 0)
+        piper = run_pipes(
+            toml_data,
+            process_flag_args(toml_data.arg, toml_args.arg),
+            toml_args.arg,
+            os.path.dirname(toml_args.toml),
+            not toml_args.no_cache
+        )
+        if not adapter_data.verify:
+            import urllib3
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        payload, prepared_req = build_request(toml_data, adapter_data, piper)
+        spec = stream_spec(toml_data, toml_args.stream, toml_args.output, None, toml_args.max_body)
+        if spec:
+            res = send_request(prepared_req, adapter_data, stream=True)
+            return pipe_output(res, payload, None, stream_body(res, spec))
+        res, cache_status = send_with_cache(toml_data, prepared_req, adapter_data, not toml_args.no_cache)
+        return pipe_output(res, payload, cache_status)
+    finally:
+        nested_run.cmd = None
+
+
+pipe_cache_dir = os.path.expanduser("~/.cache/resttoml/pipe")
+
+
+def execute_pipe(key: str, cmd: list[str], base_dir: str, processes: dict[str, subprocess.Popen]) -> Any:
+    toml_args = toml_pipe_args(cmd, base_dir)
+    if toml_args:
+        return run_toml_pipe(cmd, toml_args)
+    processes[key] = subprocess.Popen(cmd, cwd=base_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return finish_pipe(processes[key])
+
+
+def run_pipe(
+        key: str,
+        pipe: PipeData,
+        cmd: list[str],
+        base_dir: str,
+        use_cache: bool,
+        processes: dict[str, subprocess.Popen]
+) -> tuple[str, Any]:
+    if not pipe.cache_ttl or not use_cache:
+        return key, execute_pipe(key, cmd, base_dir, processes)
+    script = os.path.realpath(os.path.join(base_dir, cmd[0])) if "/" in cmd[0] else cmd[0]
+    with DiskCache(pipe_cache_dir, [script] + cmd[1:]) as cache:
+        hit, pipe_data = cache.load()
+        if not hit:
+            pipe_data = execute_pipe(key, cmd, base_dir, processes)
+            # `--pipe` exits 0 whatever the status, a failed call must not be replayed for the whole ttl.
+            match pipe_data:
+                case {"status": int() as status} if status >= 400:
+                    pass
+                case _:
+                    cache.store(pipe_data, pipe.cache_ttl)
+    return key, pipe_data
+
+
+def run_pipes(
+        toml_data: TomlData,
+        arg_dict: dict,
+        flag_args: list[str] | None,
+        base_dir: str,
+        use_cache: bool
+) -> Piper:
+    if not toml_data.pipe:
+        return Piper({"arg": arg_dict})
     all_pipe_data = {}
+    # Pipe output is added as it comes in, the args of a later pipe are filled from the ones it needs.
+    piper = Piper({"arg": arg_dict, "pipe": all_pipe_data})
     try:
-        pass_args = list(arg_pass())
-        for key, pipe in toml_data.pipe.items():
-            extra = []
-            if pipe.pass_pipe_flag:
-                extra += ["--pipe"]
-            extra += list(pipe.arg)
-            if pipe.pass_arg:
-                extra += pass_args
-            pipe_data = subprocess.run([
-                                           pipe.script
-                                       ] + extra, check=True, capture_output=True).stdout.decode('utf-8').strip()
-            all_pipe_data[key] = json.loads(pipe_data)
-        piper = Piper({"arg": arg_dict, "pipe": all_pipe_data})
+        pass_args = list(arg_pass(flag_args))
+        waiting = dict(toml_data.pipe)
+        processes = {}
+        with ThreadPoolExecutor(max_workers=len(waiting)) as executor:
+            futures = set()
+            try:
+                while waiting or futures:
+                    # Start every pipe the moment all of its needs have finished, not a whole stage at a time.
+                    for key, pipe in list(waiting.items()):
+                        if all(need in all_pipe_data for need in pipe.needs):
+                            del waiting[key]
+                            cmd = pipe_command(pipe, piper, pass_args)
+                            futures.add(executor.submit(run_pipe, key, pipe, cmd, base_dir, use_cache, processes))
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        key, pipe_data = future.result()
+                        all_pipe_data[key] = pipe_data
+            except BaseException:
+                # One pipe failed, don't wait for the others before reporting it.
+                for process in list(processes.values()):
+                    process.kill()
+                raise
     except subprocess.CalledProcessError as e:
         error_and_exit("PIPE_ERROR", e.__str__())
     except json.JSONDecodeError as e:
         error_and_exit("JSON_PIPE_ERROR", e.__str__())
+    return piper
 
 
-def process_endpoint_arg() -> str:
+def process_endpoint_arg(toml_data: TomlData, piper: Piper) -> str:
     endpoint = toml_data.http.endpoint
 
     d_poss = [i for i in range(len(endpoint)) if endpoint.startswith("#d!", i) or endpoint.startswith("//", i)]
@@ -357,47 +817,305 @@ def process_endpoint_arg() -> str:
     endpoint = piper.process(endpoint_split)
     return "/".join(str(v) for v in endpoint).rstrip("/")
 
-payload = ""
-if toml_data.http.method not in ["GET", "HEAD", "CONNECT", "TRACE", "OPTIONS"] and toml_data.http.payload:
-    if type(toml_data.http.payload) is str:
-        payload = xmltodict.parse(toml_data.http.payload)
-        payload = xmltodict.unparse(piper.process(payload), pretty=True)
-    else:
-        payload = xmltodict.unparse(piper.process(toml_data.http.payload), pretty=True)
 
-payload_parsed = {}
-if payload:
-    payload_parsed = xmltodict.parse(payload)
+session_lock = threading.Lock()
+shared_session = None
+
+
+def http_session() -> "requests.Session":
+    """The session of the whole run, `.toml` pipes run in this process send through it as well."""
+    global shared_session
+    import requests
+    with session_lock:
+        if shared_session is None:
+            shared_session = requests.Session()
+        return shared_session
+
+
+def keep_alive_headers(adapter_data: AdapterData) -> dict[str, str]:
+    if adapter_data.keep_alive:
+        return {}
+    return {"Connection": "close"}
+
+
+def compress_payload(payload: str, compress: str | None) -> str | bytes:
+    match compress:
+        case "gzip":
+            return gzip.compress(payload.encode("utf-8"))
+        case "zstd":
+            try:
+                import zstandard
+            except ImportError as e:
+                error_and_exit("COMPRESS_ERROR", f"compress = \"zstd\" needs the zstandard package: {e}")
+            return zstandard.ZstdCompressor().compress(payload.encode("utf-8"))
+    return payload
+
+
+def build_request(toml_data: TomlData, adapter_data: AdapterData, piper: Piper) -> tuple[str, "requests.PreparedRequest"]:
+    # Imported here as well, `.toml` pipes build their request before the imports further down have run.
+    import requests
+    import xmltodict
+    payload = ""
+    if toml_data.http.method not in ["GET", "HEAD", "CONNECT", "TRACE", "OPTIONS"] and toml_data.http.payload:
+        if type(toml_data.http.payload) is str:
+            payload = xmltodict.parse(toml_data.http.payload)
+            payload = xmltodict.unparse(piper.process(payload), pretty=True)
+        else:
+            payload = xmltodict.unparse(piper.process(toml_data.http.payload), pretty=True)
+
+    # Whatever urllib3 can decode, br and zstd included when their packages are installed.
+    headers = (
+        {"Accept-Encoding": requests.utils.DEFAULT_ACCEPT_ENCODING}
+        | piper.process(toml_data.http.headers)
+        | adapter_data.headers
+        | keep_alive_headers(adapter_data)
+    )
+    if payload and toml_data.http.compress:
+        headers["Content-Encoding"] = toml_data.http.compress
+
+    req = requests.Request(
+        method=toml_data.http.method,
+        url=adapter_data.url.rstrip("/") + "/" + process_endpoint_arg(toml_data, piper),
+        headers=headers,
+        params=piper.process(toml_data.http.params),
+        cookies=piper.process(toml_data.http.cookies),
+        data=compress_payload(payload, toml_data.http.compress) if payload else payload
+    )
+    return payload, req.prepare()
+
+
+def send_request(
+        prepared_req: "requests.PreparedRequest",
+        adapter_data: AdapterData,
+        stream: bool = False
+) -> "requests.Response":
+    import requests
+    try:
+        return http_session().send(
+            prepared_req,
+            verify=adapter_data.verify,
+            timeout=adapter_data.timeout(),
+            stream=stream
+        )
+    except requests.ConnectionError as e:
+        error_and_exit("REQUESTS_CONNECTION_ERROR", e.__str__())
+    except requests.Timeout as e:
+        error_and_exit("REQUESTS_TIMEOUT_ERROR", e.__str__())
 
-req = requests.Request(
-    method=toml_data.http.method,
-    url=adapter_data.url.rstrip("/") + "/" + process_endpoint_arg(),
-    headers=piper.process(toml_data.http.headers) | adapter_data.headers,
-    params=piper.process(toml_data.http.params),
-    cookies=piper.process(toml_data.http.cookies),
-    data=payload
-)
 
-session = requests.Session()
+http_cache_dir = os.path.expanduser("~/.cache/resttoml/http")
+# How long an entry outlives its max-age, with an ETag or Last-Modified it can still be revalidated for a 304.
+http_cache_keep = 7 * 24 * 3600
 
-prepared_req = req.prepare()
 
-if not adapter_data.verify:
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+def cache_control(headers: Mapping[str, str]) -> dict[str, str]:
+    directives = {}
+    for directive in headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"')
+    return directives
 
-res: requests.Response | None = None
-try:
-    res = session.send(prepared_req, verify=adapter_data.verify)
-except requests.ConnectionError as e:
-    error_and_exit("REQUESTS_CONNECTION_ERROR", e.__str__())
 
-def pretty_print_xml(xml: str) -> str:
+def fresh_until(headers: Mapping[str, str]) -> float:
+    directives = cache_control(headers)
+    if "no-cache" in directives:
+        return 0.0
     try:
-        return xmltodict.unparse(xmltodict.parse(xml), pretty=True)
+        max_age = int(directives.get("max-age", 0)) - int(headers.get("Age", 0))
+    except ValueError:
+        return 0.0
+    return time.time() + max_age
+
+
+def cached_response(entry: dict, prepared_req: "requests.PreparedRequest", elapsed: timedelta) -> "requests.Response":
+    import requests
+    res = requests.Response()
+    res.status_code = entry["status"]
+    res.reason = entry["reason"]
+    res.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+    res.encoding = requests.utils.get_encoding_from_headers(res.headers)
+    res._content = base64.b64decode(entry["body"])
+    res.url = prepared_req.url
+    res.request = prepared_req
+    res.elapsed = elapsed
+    return res
+
+
+def send_with_cache(
+        toml_data: TomlData,
+        prepared_req: "requests.PreparedRequest",
+        adapter_data: AdapterData,
+        use_cache: bool
+) -> tuple["requests.Response", str | None]:
+    """Send a GET with `[http] cache = true` through the cache, along with whether it was a `hit`, `revalidated` or a `miss`.
+
+    A fresh entry is served without a request, a stale one is sent with `If-None-Match`/`If-Modified-Since`
+    and served again on a 304.
+    """
+    import requests
+    if not toml_data.http.cache or prepared_req.method != "GET":
+        return send_request(prepared_req, adapter_data), None
+    if not use_cache:
+        return send_request(prepared_req, adapter_data), "bypass"
+    # Every request header is part of the key, so responses for another token are never mixed up.
+    with DiskCache(http_cache_dir, [prepared_req.method, prepared_req.url, sorted(prepared_req.headers.items())]) as cache:
+        hit, entry = cache.load()
+        if hit and entry["fresh_until"] > time.time():
+            return cached_response(entry, prepared_req, timedelta(0)), "hit"
+        headers = requests.structures.CaseInsensitiveDict(entry["headers"] if hit else {})
+        if "ETag" in headers:
+            prepared_req.headers["If-None-Match"] = headers["ETag"]
+        if "Last-Modified" in headers:
+            prepared_req.headers["If-Modified-Since"] = headers["Last-Modified"]
+        res = send_request(prepared_req, adapter_data)
+        if hit and res.status_code == 304:
+            # A 304 refreshes the stored headers, but the length and encoding still describe the stored body.
+            headers.update({
+                key: value for key, value in res.headers.items()
+                if key.lower() not in ("content-length", "content-encoding", "transfer-encoding")
+            })
+            entry["headers"] = dict(headers)
+            entry["fresh_until"] = fresh_until(res.headers)
+            cache.store(entry, http_cache_keep)
+            return cached_response(entry, prepared_req, res.elapsed), "revalidated"
+        if res.status_code == 200 and "no-store" not in cache_control(res.headers):
+            entry = {
+                "fresh_until": fresh_until(res.headers),
+                "status": res.status_code,
+                "reason": res.reason,
+                "headers": dict(res.headers),
+                "body": base64.b64encode(res.content).decode("ascii")
+            }
+            if entry["fresh_until"] > time.time() or "ETag" in res.headers or "Last-Modified" in res.headers:
+                cache.store(entry, http_cache_keep)
+        return res, "miss"
+
+
+# A tag that starts an indented line, found in anything the server already formatted.
+formatted_xml = re.compile(r">\s*\n[ \t]+<")
+
+
+def pretty_print_xml(xml: str, parsed: dict | None = None) -> str:
+    """Indent the XML for display, parsing it only if neither the server nor the caller already did."""
+    import xmltodict
+    if formatted_xml.search(xml):
+        return xml
+    try:
+        return xmltodict.unparse(parsed if parsed is not None else xmltodict.parse(xml), pretty=True)
     except (ValueError, ExpatError):
         return ""
 
-if flag_pipe:
+
+@dataclass(frozen=True)
+class StreamSpec():
+    output: str | None = None
+    item_depth: int | None = None
+    max_body: int | None = None
+
+
+def stream_spec(
+        toml_data: TomlData,
+        stream: bool,
+        output: str | None,
+        item_depth: int | None,
+        max_body: int | None
+) -> StreamSpec | None:
+    """How to read the body in chunks, `None` to read it whole. Writing it out, items or capping it all need chunks."""
+    if not (stream or toml_data.http.stream or output or item_depth or max_body):
+        return None
+    return StreamSpec(output=output, item_depth=item_depth, max_body=max_body)
+
+
+@dataclass(frozen=True)
+class StreamedBody():
+    body: Any
+    size: int
+    output: str | None = None
+
+
+def stream_body(
+        res: "requests.Response",
+        spec: StreamSpec,
+        on_item: Callable[[str, Any], None] | None = None
+) -> StreamedBody:
+    """Parse the body as it arrives. With `item_depth` each element at that depth goes to `on_item` and is dropped."""
+    import requests
+    import xmltodict
+    size = 0
+
+    def chunks(output) -> Iterator[bytes]:
+        nonlocal size
+        for chunk in res.iter_content(chunk_size=1 << 16):
+            size += len(chunk)
+            if spec.max_body and size > spec.max_body:
+                error_and_exit("RESPONSE_BODY_TOO_LARGE", f"{res.request.url} sent more than {spec.max_body} bytes")
+            if spec.output:
+                output.write(chunk)
+            yield chunk
+
+    def item_callback(path: list, item: Any) -> bool:
+        on_item(path[-1][0], item)
+        return True
+
+    try:
+        with res, open(spec.output or os.devnull, "wb") as output:
+            if on_item:
+                xmltodict.parse(chunks(output), item_depth=spec.item_depth, item_callback=item_callback)
+                return StreamedBody(None, size, spec.output)
+            if spec.output:
+                for _ in chunks(output):
+                    pass
+                return StreamedBody(None, size, spec.output)
+            return StreamedBody(xmltodict.parse(chunks(output)), size)
+    except requests.RequestException as e:
+        error_and_exit("REQUESTS_CONNECTION_ERROR", e.__str__())
+    except OSError as e:
+        error_and_exit("OS_ERROR", e.__str__())
+    except ExpatError as e:
+        error_and_exit("XML_RESPONSE_ERROR", e.__str__())
+
+
+def body_size(body: str | bytes | None) -> int:
+    if body is None:
+        return 0
+    return len(body.encode("utf-8") if type(body) is str else body)
+
+
+def received_size(res: "requests.Response", decoded: int) -> int | None:
+    # urllib3 does not count chunked bodies, without a Content-Encoding they are as long as decoded.
+    if res.raw is None:
+        return 0
+    if res.raw.chunked:
+        return None if "Content-Encoding" in res.headers else decoded
+    return res.raw.tell()
+
+
+def transfer_size(res: "requests.Response", payload: str, decoded: int) -> dict:
+    """Bytes on the wire next to the bytes they decode to, for the payload sent and the body received."""
+    return {
+        "request": {"wire": body_size(res.request.body), "decoded": body_size(payload)},
+        # A response served from the cache has nothing left to read.
+        "response": {"wire": received_size(res, decoded), "decoded": decoded}
+    }
+
+
+def pipe_output(
+        res: "requests.Response",
+        payload: str,
+        cache_status: str | None,
+        streamed: StreamedBody | None = None
+) -> dict:
+    import xmltodict
+    payload_parsed = {}
+    if payload:
+        payload_parsed = xmltodict.parse(payload)
+    if streamed:
+        # The text was never held, only what it parsed to.
+        body, body_original = streamed.body, None
+    else:
+        body = xmltodict.parse(res.text)
+        body_original = pretty_print_xml(res.text, body)
     cookies_ = {}
     if "set-cookie" in dict(res.headers):
         for cookie in dict(res.headers["set-cookie"]):
@@ -405,7 +1123,7 @@ if flag_pipe:
             simple_cookie.load(cookie)
             for key, morsel in simple_cookie.items():
                 cookies_[key] = morsel.value
-    json_output = {
+    output = {
         "edition": "xml",
         "request": {
             "headers": dict(res.request.headers),
@@ -417,16 +1135,258 @@ if flag_pipe:
         "status": res.status_code,
         "headers": dict(res.headers),
         "cookies": cookies_,
-        "body": xmltodict.parse(res.text),
-        "body_original": pretty_print_xml(res.text),
-        "elapsed": f"{res.elapsed}"
+        "body": body,
+        "body_original": body_original,
+        "elapsed": f"{res.elapsed}",
+        "size": transfer_size(res, payload, streamed.size if streamed else len(res.content))
+    }
+    if cache_status:
+        output["cache"] = cache_status
+    if streamed and streamed.output:
+        output["output"] = streamed.output
+    return output
+
+
+arg_dict = process_flag_args(toml_data.arg, flag_args)
+piper = run_pipes(toml_data, arg_dict, flag_args, ".", not flag_no_cache)
+
+# Imported this late so runs that stop on a TOML, adapter or pipe error never pay for them.
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+payload, prepared_req = build_request(toml_data, adapter_data, piper)
+
+session = http_session()
+
+
+def mount_http_adapter(pool_maxsize: int):
+    http_adapter = HTTPAdapter(
+        pool_connections=adapter_data.pool_connections,
+        pool_maxsize=adapter_data.pool_maxsize or pool_maxsize,
+        # Only failing to connect is retried, a read timeout is reported as one.
+        max_retries=urllib3.util.Retry(total=adapter_data.max_retries, read=False),
+        pool_block=adapter_data.pool_block
+    )
+    session.mount("http://", http_adapter)
+    session.mount("https://", http_adapter)
+
+
+mount_http_adapter(requests.adapters.DEFAULT_POOLSIZE)
+if not adapter_data.verify:
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+
+class LatencyHistogram:
+    """HDR-style histogram of latencies in microseconds.
+
+    Values keep their top 8 bits, so any recorded value is off by less than 1%, whatever its magnitude,
+    and memory only grows with the number of distinct buckets hit.
+    """
+    __counts: dict[int, int]
+    count: int
+    total: int
+    min: int
+    max: int
+
+    def __init__(self):
+        self.__counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def record(self, seconds: float):
+        value = max(int(seconds * 1_000_000), 0)
+        index = self.__index(value)
+        self.__counts[index] = self.__counts.get(index, 0) + 1
+        self.min = value if not self.count else min(self.min, value)
+        self.max = max(self.max, value)
+        self.count += 1
+        self.total += value
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent: float) -> int:
+        if not self.count:
+            return 0
+        rank = max(math.ceil(self.count * percent / 100), 1)
+        seen = 0
+        for index in sorted(self.__counts):
+            seen += self.__counts[index]
+            if seen >= rank:
+                return min(self.__highest(index), self.max)
+        return self.max
+
+    @staticmethod
+    def __index(value: int) -> int:
+        if value < 256:
+            return value
+        shift = value.bit_length() - 8
+        return (shift << 8) | (value >> shift)
+
+    @staticmethod
+    def __highest(index: int) -> int:
+        shift = index >> 8
+        return (((index & 255) + 1) << shift) - 1
+
+
+class LoadStats:
+    """Responses seen during `--load`, reported once the duration is over."""
+    histogram: LatencyHistogram
+    status: dict[str, int]
+    errors: dict[str, int]
+    skipped: int
+
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        self.status = {}
+        self.errors = {}
+        self.skipped = 0
+        self.__lock = threading.Lock()
+
+    def skip(self):
+        with self.__lock:
+            self.skipped += 1
+
+    def record(self, status_code: int | None, error: str | None, latency: float):
+        with self.__lock:
+            if error:
+                self.errors[error] = self.errors.get(error, 0) + 1
+                return
+            status_class = f"{status_code // 100}xx"
+            self.status[status_class] = self.status.get(status_class, 0) + 1
+            self.histogram.record(latency)
+
+    def requests(self) -> int:
+        return self.histogram.count + sum(self.errors.values())
+
+
+def run_load(spec: LoadSpec) -> tuple[LoadStats, float]:
+    stats = LoadStats()
+    mount_http_adapter(spec.concurrency)
+
+    def send(scheduled: float):
+        # A request still queued when the duration is over is counted instead of sent,
+        # a server falling behind the rate would otherwise keep the run going.
+        if time.perf_counter() >= deadline:
+            stats.skip()
+            return
+        # Latency counts from when the request was due, not when a worker got to it,
+        # so a server that falls behind the target rate shows up in the percentiles.
+        try:
+            res = session.send(prepared_req.copy(), verify=adapter_data.verify, timeout=adapter_data.timeout())
+            stats.record(res.status_code, None, time.perf_counter() - scheduled)
+        except requests.ConnectionError:
+            stats.record(None, "REQUESTS_CONNECTION_ERROR", time.perf_counter() - scheduled)
+        except requests.Timeout:
+            stats.record(None, "REQUESTS_TIMEOUT_ERROR", time.perf_counter() - scheduled)
+
+    def send_until(deadline: float):
+        while time.perf_counter() < deadline:
+            send(time.perf_counter())
+
+    start = time.perf_counter()
+    deadline = start + spec.duration
+    with ThreadPoolExecutor(max_workers=spec.concurrency) as executor:
+        if spec.rps is None:
+            for _ in range(spec.concurrency):
+                executor.submit(send_until, deadline)
+        else:
+            sent = 0
+            while True:
+                scheduled = start + sent / spec.rps
+                if scheduled >= deadline:
+                    break
+                time.sleep(max(scheduled - time.perf_counter(), 0))
+                executor.submit(send, scheduled)
+                sent += 1
+    return stats, time.perf_counter() - start
+
+
+if load_spec:
+    load_stats, load_elapsed = run_load(load_spec)
+    histogram = load_stats.histogram
+    load_output = {
+        "edition": "xml",
+        "url": prepared_req.url,
+        "method": prepared_req.method,
+        "target_rps": load_spec.rps,
+        "concurrency": load_spec.concurrency,
+        "requests": load_stats.requests(),
+        "skipped": load_stats.skipped,
+        "status": load_stats.status,
+        "errors": load_stats.errors,
+        "elapsed": f"{timedelta(seconds=load_elapsed)}",
+        "rps": load_stats.requests() / load_elapsed,
+        "latency_ms": {
+            "min": histogram.min / 1000,
+            "mean": histogram.mean() / 1000,
+            "p50": histogram.percentile(50) / 1000,
+            "p90": histogram.percentile(90) / 1000,
+            "p99": histogram.percentile(99) / 1000,
+            "max": histogram.max / 1000
+        }
     }
+    if flag_pipe:
+        if flag_indent:
+            json.dump(load_output, sys.stdout, indent="\t")
+        else:
+            json.dump(load_output, sys.stdout)
+        exit(0)
+    print("-- Load --")
+    print(f"URL: {load_output["url"]}")
+    print(f"Method: {load_output["method"]}")
+    print(f"Target: {f"{load_spec.rps:g} req/s" if load_spec.rps else "as fast as possible"}")
+    print(f"Concurrency: {load_spec.concurrency}")
+    print(f"Requests: {load_output["requests"]}")
+    print(f"Skipped: {load_output["skipped"]}")
+    print(f"Status: {", ".join(f"{key}={value}" for key, value in sorted(load_stats.status.items())) or "-"}")
+    print(f"Errors: {", ".join(f"{key}={value}" for key, value in sorted(load_stats.errors.items())) or "-"}")
+    print(f"Elapsed: {load_output["elapsed"]}")
+    print(f"Throughput: {load_output["rps"]:.2f} req/s")
+    print(
+        "Latency (ms): "
+        + " ".join(f"{key}={value:.2f}" for key, value in load_output["latency_ms"].items())
+    )
+    exit(0)
+
+# Streamed bodies skip the cache, it would have to hold the whole body.
+body_stream_spec = stream_spec(toml_data, flag_stream, flag_output, flag_item_depth, flag_max_body)
+streamed = None
+if body_stream_spec:
+    res, cache_status = send_request(prepared_req, adapter_data, stream=True), None
+    # Items are handed out while the body is read, after the response lines are printed.
+    if not flag_item_depth:
+        streamed = stream_body(res, body_stream_spec)
+else:
+    res, cache_status = send_with_cache(toml_data, prepared_req, adapter_data, not flag_no_cache)
+
+
+def write_item(tag: str, item: Any):
+    # One line per item, the way `[batch] format = "ndjson"` reads rows.
+    sys.stdout.write(json.dumps({tag: item}) + "\n")
+
+
+if flag_pipe and flag_item_depth:
+    stream_body(res, body_stream_spec, write_item)
+    exit(0)
+
+if flag_pipe:
+    json_output = pipe_output(res, payload, cache_status, streamed)
     if flag_indent:
         json.dump(json_output, sys.stdout, indent="\t")
     else:
         json.dump(json_output, sys.stdout)
     exit(0)
 
+# Only the human-readable output uses rich, `--pipe` runs never import it.
+from rich.pretty import pprint
+from rich.console import Console
+from rich.syntax import Syntax
+import xmltodict
+
 console = Console()
 
 if flag_show_request:
@@ -439,12 +1399,37 @@ print("-- Response --")
 print(f"URL: {res.request.url}")
 print(f"Status: {res.status_code}")
 print(f"Elapsed: {res.elapsed}")
+if cache_status:
+    print(f"Cache: {cache_status}")
 if flag_show_header:
     print("-- Response Headers --")
     pprint(dict(res.headers), expand_all=True)
 print("-- Response Body --")
 
 
-if not res.text:
+def print_item(tag: str, item: Any):
+    console.print(Syntax(
+        xmltodict.unparse({tag: item}, pretty=True, full_document=False),
+        "xml",
+        background_color="black"
+    ))
+
+
+if flag_item_depth:
+    streamed = stream_body(res, body_stream_spec, print_item)
+if streamed and streamed.body is None:
+    if flag_output:
+        print(f"Written to {flag_output} ({streamed.size} bytes)")
+    exit(0)
+if streamed:
+    body_text = xmltodict.unparse(streamed.body, pretty=True)
+elif res.text:
+    body_text = pretty_print_xml(res.text)
+else:
     exit(0)
-console.print(Syntax(pretty_print_xml(res.text), "xml", background_color="black"))
+if flag_max_display and len(body_text) > flag_max_display:
+    # Highlighting a huge body takes longer than reading it, show the start as it is.
+    print(body_text[:flag_max_display])
+    print(f"... {len(body_text) - flag_max_display} more characters, '--output' keeps all of it")
+else:
+    console.print(Syntax(body_text, "xml", background_color="black"))
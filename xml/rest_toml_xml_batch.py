@@ -3,23 +3,44 @@
 # requires-python = ">=3.13"
 # dependencies = [
 #   "requests>=2.32.3",
+#   "urllib3[brotli,zstd]>=2.2.0",
+#   "zstandard>=0.23.0",
+#   "httpx[http2,brotli,zstd]>=0.28.1",
 #   "rich>=13.9.4",
 #   "xmltodict>=0.14.2"
 # ]
 # ///
 import argparse
+import asyncio
+import csv
+import fcntl
+import gzip
+import hashlib
+import heapq
 import json
+import math
 import os
+import random
+import re
 import subprocess
 import sys
+import tempfile
+import time
 import tomllib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
 from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from xml.parsers.expat import ExpatError
+from xml.sax.saxutils import escape, quoteattr
 from typing import Self, Any
-from collections.abc import Iterator, MutableMapping
+from collections.abc import Callable, Iterator, AsyncIterator
 
+import httpx
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
 import xmltodict
 from rich.console import Console
 from rich.pretty import pprint
@@ -36,12 +57,49 @@ parser = argparse.ArgumentParser(description="Process Batch HTTP Rest request fo
 parser.add_argument("toml")
 parser.add_argument("--adapter")
 parser.add_argument("--show-request", action='store_true')
+parser.add_argument("--pipe", "--ndjson", dest="pipe", action='store_true')
+
+
+def concurrency_type(value: str) -> int | str:
+    if value == "auto":
+        return value
+    return int(value)
+
+
+parser.add_argument("--concurrency", type=concurrency_type, default=1)
+parser.add_argument("--max-concurrency", type=int, default=64)
+parser.add_argument("--unordered", action='store_true')
+parser.add_argument("--engine", choices=["thread", "async"], default="thread")
+parser.add_argument("--retries", type=int, default=0)
+parser.add_argument("--backoff", type=float, default=0.5)
+parser.add_argument("--checkpoint")
+parser.add_argument("--resume", action='store_true')
+parser.add_argument("--dead-letter")
+parser.add_argument("--latency-csv")
+parser.add_argument("--no-cache", action='store_true')
 
 args = parser.parse_args()
 
 arg_toml = args.toml
 flag_adapter = args.adapter
 flag_show_request = args.show_request
+flag_pipe = args.pipe
+flag_adaptive = args.concurrency == "auto"
+# With `auto` the controller moves between 1 and `--max-concurrency`, so pools are sized for the ceiling.
+flag_concurrency = max(args.max_concurrency if flag_adaptive else args.concurrency, 1)
+flag_unordered = args.unordered
+flag_engine = args.engine
+flag_retries = max(args.retries, 0)
+flag_backoff = args.backoff
+# Resolved now, the working directory moves to the TOML file's folder further down.
+flag_checkpoint = os.path.abspath(args.checkpoint) if args.checkpoint else None
+flag_resume = args.resume
+flag_dead_letter = os.path.abspath(args.dead_letter) if args.dead_letter else None
+flag_latency_csv = os.path.abspath(args.latency_csv) if args.latency_csv else None
+flag_no_cache = args.no_cache
+
+if flag_resume and not flag_checkpoint:
+    error_and_exit("RESUME_ERROR", "'--resume' needs '--checkpoint'")
 
 # https://github.com/CJ-Jackson/AnimalApiTestServer
 adapter_data = {
@@ -53,18 +111,106 @@ adapter_data = {
     "verify": True,
 }
 
-if flag_adapter:
+
+class DiskCache:
+    """A JSON entry on disk that expires, one file per key under `directory`, readable by the user only.
+
+    The entry is locked for the whole `with` block, so concurrent runs wait for the one refreshing it instead of all doing so.
+    """
+    __directory: str
+    __path: str
+    __lock: int | None
+
+    def __init__(self, directory: str, key: list):
+        self.__directory = directory
+        self.__path = os.path.join(directory, f"{hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()}.json")
+        self.__lock = None
+
+    def __enter__(self) -> Self:
+        try:
+            os.makedirs(self.__directory, mode=0o700, exist_ok=True)
+            self.__lock = os.open(f"{self.__path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self.__lock, fcntl.LOCK_EX)
+        except OSError as e:
+            error_and_exit("CACHE_ERROR", e.__str__())
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.__lock is not None:
+            os.close(self.__lock)
+
+    def load(self) -> tuple[bool, Any]:
+        try:
+            with open(self.__path, "rb") as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return False, None
+        match entry:
+            case {"expires": int() | float() as expires, "data": data} if expires > time.time():
+                return True, data
+            case _:
+                return False, None
+
+    def store(self, data: Any, ttl: float):
+        # Written next to the entry and renamed over it, a reader never sees half a file.
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.__directory, prefix=".tmp-")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"expires": time.time() + ttl, "data": data}, f)
+            os.replace(tmp_path, self.__path)
+        except OSError as e:
+            error_and_exit("CACHE_ERROR", e.__str__())
+
+
+adapter_cache_dir = os.path.expanduser("~/.cache/resttoml/adapter/xml")
+
+
+def adapter_ttl(data: Any) -> float | None:
+    """How long the adapter output may be reused, `cache_ttl` as is or `expires_in` of a token a little early."""
+    match data:
+        case {"cache_ttl": int() | float() as cache_ttl} if cache_ttl > 0:
+            return cache_ttl
+        case {"expires_in": int() | float() as expires_in} if expires_in > 30:
+            return expires_in - 30
+        case _:
+            return None
+
+
+def run_adapter(path: str) -> Any:
     try:
-        adapter_data = subprocess.run([
-            os.path.expanduser(f"~/.config/resttoml/xml/{flag_adapter}")
-        ], check=True, capture_output=True).stdout.decode('utf-8')
-        adapter_data = json.loads(adapter_data)
+        adapter_data = subprocess.run([path], check=True, capture_output=True).stdout.decode('utf-8')
+        return json.loads(adapter_data)
     except subprocess.CalledProcessError as e:
         error_and_exit("FLAG_ADAPTER_ERROR", e.__str__())
     except json.JSONDecodeError as e:
         error_and_exit("FLAG_ADAPTER_JSON_ERROR", e.__str__())
 
 
+def fetch_adapter(name: str, use_cache: bool) -> Any:
+    """Output of the adapter script, reused for as long as it says through `cache_ttl` or `expires_in`."""
+    path = os.path.expanduser(f"~/.config/resttoml/xml/{name}")
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        use_cache = False
+    if not use_cache:
+        return run_adapter(path)
+    with DiskCache(adapter_cache_dir, [path]) as cache:
+        match cache.load():
+            # An edited adapter script is run again, whatever its last output said.
+            case True, {"mtime": cached_mtime, "adapter": adapter_data} if cached_mtime == mtime:
+                return adapter_data
+        adapter_data = run_adapter(path)
+        ttl = adapter_ttl(adapter_data)
+        if ttl:
+            cache.store({"mtime": mtime, "adapter": adapter_data}, ttl)
+        return adapter_data
+
+
+if flag_adapter:
+    adapter_data = fetch_adapter(flag_adapter, not flag_no_cache)
+
+
 class AdapterDataError(Exception): pass
 
 
@@ -73,6 +219,14 @@ class AdapterData():
     url: str
     headers: dict[str, str]
     verify: bool = True
+    pool_connections: int = 10
+    # None leaves the pool size to the runner.
+    pool_maxsize: int | None = None
+    pool_block: bool = False
+    connect_timeout: float | None = None
+    read_timeout: float | None = None
+    max_retries: int = 0
+    keep_alive: bool = True
 
     @classmethod
     def create(cls, data: dict):
@@ -81,12 +235,31 @@ class AdapterData():
                 pass
             case _:
                 raise AdapterDataError("Adapter must have 'url'(str) and 'headers'(dict)")
+        for name, minimum in (("pool_connections", 1), ("pool_maxsize", 1), ("max_retries", 0)):
+            if name in data and (type(data[name]) is not int or data[name] < minimum):
+                raise AdapterDataError(f"'{name}' must be an integer of at least {minimum}")
+        for name in ("connect_timeout", "read_timeout"):
+            if name in data and (type(data[name]) not in (int, float) or data[name] <= 0):
+                raise AdapterDataError(f"'{name}' must be a positive number of seconds")
+        for name in ("pool_block", "keep_alive"):
+            if name in data and type(data[name]) is not bool:
+                raise AdapterDataError(f"'{name}' must be a bool")
         return cls(
             url=data["url"],
             headers=data["headers"],
-            verify=data.get("verify", True)
+            verify=data.get("verify", True),
+            pool_connections=data.get("pool_connections", 10),
+            pool_maxsize=data.get("pool_maxsize", None),
+            pool_block=data.get("pool_block", False),
+            connect_timeout=data.get("connect_timeout", None),
+            read_timeout=data.get("read_timeout", None),
+            max_retries=data.get("max_retries", 0),
+            keep_alive=data.get("keep_alive", True)
         )
 
+    def timeout(self) -> tuple[float | None, float | None]:
+        return self.connect_timeout, self.read_timeout
+
 
 try:
     adapter_data = AdapterData.create(adapter_data)
@@ -118,6 +291,7 @@ class HttpData():
     cookies: dict[str, str] = field(default_factory=dict[str, str])
     payload: dict[str, Any] | str = field(default_factory=dict[str, Any])
     method: str = "GET"
+    compress: str | None = None
 
     @classmethod
     def create(cls, data: dict) -> Self:
@@ -126,6 +300,8 @@ class HttpData():
                 pass
             case _:
                 raise HttpDataError("Must have 'endpoint'(str)")
+        if data.get("compress", None) not in (None, "gzip", "zstd"):
+            raise HttpDataError("'compress' must be \"gzip\" or \"zstd\"")
         return cls(
             endpoint=data["endpoint"],
             params=data.get("params", {}),
@@ -133,6 +309,7 @@ class HttpData():
             cookies=data.get("cookies", {}),
             payload=data.get("payload", {}),
             method=data.get("method", "GET").strip().upper(),
+            compress=data.get("compress", None),
         )
 
 
@@ -144,6 +321,7 @@ class BatchData():
     script: str
     arg: tuple = ()
     key: str = "batch"
+    format: str = "json"
 
     @classmethod
     def create(cls, data: dict) -> Self:
@@ -152,10 +330,16 @@ class BatchData():
                 pass
             case _:
                 raise BatchDataError("Must have 'script'(str)")
+        match data.get("format", "json"):
+            case "json" | "ndjson":
+                pass
+            case _:
+                raise BatchDataError("'format' must be 'json' or 'ndjson'")
         return cls(
             script=data["script"],
             arg=tuple(data.get("arg", [])),
-            key=data.get("key", "batch")
+            key=data.get("key", "batch"),
+            format=data.get("format", "json")
         )
 
 
@@ -190,68 +374,89 @@ except BatchDataError as e:
     error_and_exit("BATCH_DATA_ERROR", e.__str__())
 
 
-def _list_to_dict(v: list) -> Iterator[tuple[str, Any]]:
-    yield "_", tuple(v)
-    for i in range(len(v)):
-        yield str(i), v[i]
-
-
-def _flatten_dict_gen(d, parent_key, sep) -> Iterator[tuple[str, Any]]:
-    for k, v in d.items():
-        if type(v) is list:
-            v = dict(_list_to_dict(v))
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, MutableMapping):
-            yield from flatten_dict(v, new_key, sep=sep).items()
-        else:
-            yield new_key, v
+def resolve_path(data: dict | list, path: str) -> Any:
+    """Look up a `#d!` path in the nested data.
 
-
-def flatten_dict(d: MutableMapping, parent_key: str = '', sep: str = '/') -> dict:
-    return dict(_flatten_dict_gen(d, parent_key, sep))
+    Lists are stepped into by index, or `_` for the whole list as a tuple.
+    Only leaves can be looked up, a path ending on a dict or a list raises `KeyError` like a missing key.
+    """
+    value: Any = data
+    try:
+        for key in path.split("/"):
+            match value:
+                case dict():
+                    value = value[key]
+                case list() if key == "_":
+                    value = tuple(value)
+                case list():
+                    value = value[int(key)]
+                case _:
+                    raise KeyError(path)
+    except (KeyError, IndexError, ValueError):
+        raise KeyError(path)
+    if type(value) is dict or type(value) is list:
+        raise KeyError(path)
+    return value
+
+
+class PiperTemplate:
+    """A template walked once up front, so processing a row only fills in its `#d!` slots."""
+    __value: Any
+    __fill: Callable[[Callable[[str], Any]], Any] | None
+
+    def __init__(self, user_data: Any):
+        self.__value = user_data
+        self.__fill = self.__compile(user_data)
+
+    def fill(self, get: Callable[[str], Any]) -> Any:
+        if self.__fill is None:
+            return self.__value
+        return self.__fill(get)
+
+    def __compile(self, value: Any) -> Callable[[Callable[[str], Any]], Any] | None:
+        # Returns None for a subtree without slots, it is then reused as is for every row.
+        match value:
+            case str() if value.startswith("#d!"):
+                path = value[3:].strip('/')
+                return lambda get: get(path)
+            case dict():
+                parts = tuple((key, self.__compile(item), item) for key, item in value.items())
+                if all(fill is None for _, fill, _ in parts):
+                    return None
+                return lambda get: {key: item if fill is None else fill(get) for key, fill, item in parts}
+            case list():
+                parts = tuple((self.__compile(item), item) for item in value)
+                if all(fill is None for fill, _ in parts):
+                    return None
+                return lambda get: [item if fill is None else fill(get) for fill, item in parts]
+            case _:
+                return None
 
 
 class Piper:
     __data: dict
+    __cache: dict[str, Any]
 
     def __init__(self, data: dict):
-        self.__data = flatten_dict(data)
+        self.__data = data
+        self.__cache = {}
 
-    def process(self, user_data: dict | list) -> dict | list | None:
+    def process(self, user_data: PiperTemplate | dict | list) -> Any:
+        if not isinstance(user_data, PiperTemplate):
+            user_data = PiperTemplate(user_data)
         try:
-            if type(user_data) is dict:
-                return dict(self.__process_dict(user_data))
-            elif type(user_data) is list:
-                return list(self.__process_list(user_data))
+            return user_data.fill(self.__get)
         except KeyError as ex:
             error_and_exit(
                 "PIPER_KEY_ERROR",
                 f"'#d!{ex.__str__().strip("'")}' not found"
             )
 
-    def __process_list(self, user_data: list) -> Iterator[Any]:
-        for i in range(len(user_data)):
-            match user_data[i]:
-                case str() if str(user_data[i]).startswith("#d!"):
-                    yield self.__data[str(user_data[i])[3:].strip('/')]
-                case dict():
-                    yield dict(self.__process_dict(user_data[i]))
-                case list():
-                    yield list(self.__process_list(user_data[i]))
-                case _:
-                    yield user_data[i]
-
-    def __process_dict(self, user_data: dict) -> Iterator[tuple[str, Any]]:
-        for key, value in user_data.items():
-            match value:
-                case str() if str(value).startswith("#d!"):
-                    yield key, self.__data[str(value)[3:].strip('/')]
-                case dict():
-                    yield key, dict(self.__process_dict(value))
-                case list():
-                    yield key, list(self.__process_list(value))
-                case _:
-                    yield key, value
+    def __get(self, path: str) -> Any:
+        # Paths are only resolved when a template asks for them, large pipe output is never walked as a whole.
+        if path not in self.__cache:
+            self.__cache[path] = resolve_path(self.__data, path)
+        return self.__cache[path]
 
 
 endpoint = toml_data.http.endpoint
@@ -265,80 +470,802 @@ for pos in d_poss:
     previous_pos = pos
 endpoint_split.append(endpoint[previous_pos:].strip("/"))
 
+endpoint_template = PiperTemplate(endpoint_split)
+headers_template = PiperTemplate(toml_data.http.headers)
+params_template = PiperTemplate(toml_data.http.params)
+cookies_template = PiperTemplate(toml_data.http.cookies)
+
+# A slot's marker after unparse, in quotes when it is an attribute value.
+xml_slot = re.compile(r'"\ue000(\d+)\ue001"|\ue000(\d+)\ue001')
+
+
+def xml_value(value: Any, attribute: bool) -> str:
+    """A slot value escaped the way `xmltodict.unparse` writes it as an attribute or as text."""
+    if value is None:
+        text = ""
+    elif type(value) is bool:
+        text = "true" if value else "false"
+    else:
+        text = str(value)
+    return quoteattr(text) if attribute else escape(text)
+
+
+class XmlPayloadTemplate(PiperTemplate):
+    """The payload unparsed once with a marker in each `#d!` slot, so a row only escapes its values into place.
+
+    A `_` path fills its slot with a list, which repeats the element, a row with one is unparsed as a whole instead.
+    """
+    __slots: list[tuple[str, str, bool]]
+    __tail: str
+
+    def __init__(self, user_data: Any):
+        super().__init__(user_data)
+        paths = []
+
+        def mark(value: Any) -> Any:
+            match value:
+                case str() if value.startswith("#d!"):
+                    paths.append(value[3:].strip("/"))
+                    # Private use characters, unparse leaves them alone wherever they end up.
+                    return f"\ue000{len(paths) - 1}\ue001"
+                case dict():
+                    return {key: mark(item) for key, item in value.items()}
+                case list():
+                    return [mark(item) for item in value]
+                case _:
+                    return value
+
+        pieces = xml_slot.split(xmltodict.unparse(mark(user_data), pretty=True))
+        # Split gives the text before a slot, then the slot as an attribute or as text.
+        self.__slots = [
+            (pieces[pos], paths[int(pieces[pos + 1] or pieces[pos + 2])], pieces[pos + 1] is not None)
+            for pos in range(0, len(pieces) - 1, 3)
+        ]
+        self.__tail = pieces[-1]
+
+    def fill(self, get: Callable[[str], Any]) -> str:
+        parts = []
+        for text, path, attribute in self.__slots:
+            value = get(path)
+            if type(value) in (tuple, list, dict):
+                return xmltodict.unparse(super().fill(get), pretty=True)
+            parts.append(text)
+            parts.append(xml_value(value, attribute))
+        parts.append(self.__tail)
+        return "".join(parts)
+
+
+payload_template: XmlPayloadTemplate | None = None
+if toml_data.http.method not in ["GET", "HEAD", "CONNECT", "TRACE", "OPTIONS"] and toml_data.http.payload:
+    try:
+        if type(toml_data.http.payload) is str:
+            payload_template = XmlPayloadTemplate(xmltodict.parse(toml_data.http.payload))
+        else:
+            payload_template = XmlPayloadTemplate(toml_data.http.payload)
+    except (ValueError, ExpatError) as e:
+        error_and_exit("XML_PAYLOAD_ERROR", e.__str__())
+
 
 def process_endpoint_arg(piper: Piper) -> str:
-    endpoint = piper.process(endpoint_split)
+    endpoint = piper.process(endpoint_template)
     return "/".join(str(v) for v in endpoint).rstrip("/")
 
 
-batch: list | None = None
-try:
-    batch_data = subprocess.run([
-                                    toml_data.batch.script
-                                ] + list(toml_data.batch.arg), capture_output=True, check=True).stdout.decode('utf-8')
-    batch_data = json.loads(batch_data)
-    batch = batch_data[toml_data.batch.key]
-except KeyError as e:
-    error_and_exit("BATCH_KEY_ERROR", e.__str__())
-except json.JSONDecodeError as e:
-    error_and_exit("BATCH_JSON_ERROR", e.__str__())
-except subprocess.CalledProcessError as e:
-    error_and_exit("BATCH_PROCESS_ERROR", e.__str__())
+def load_batch() -> list:
+    batch: list | None = None
+    try:
+        batch_data = subprocess.run([
+                                        toml_data.batch.script
+                                    ] + list(toml_data.batch.arg), capture_output=True, check=True).stdout.decode('utf-8')
+        batch_data = json.loads(batch_data)
+        batch = batch_data[toml_data.batch.key]
+    except KeyError as e:
+        error_and_exit("BATCH_KEY_ERROR", e.__str__())
+    except json.JSONDecodeError as e:
+        error_and_exit("BATCH_JSON_ERROR", e.__str__())
+    except subprocess.CalledProcessError as e:
+        error_and_exit("BATCH_PROCESS_ERROR", e.__str__())
+    return batch
+
+
+def stream_batch() -> Iterator[dict]:
+    """Yield one row per NDJSON line while the batch script is still writing the rest."""
+    process = subprocess.Popen([
+                                   toml_data.batch.script
+                               ] + list(toml_data.batch.arg), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    finished = False
+    try:
+        for line in process.stdout:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                error_and_exit("BATCH_JSON_ERROR", e.__str__())
+        finished = True
+    finally:
+        process.stdout.close()
+        if not finished:
+            process.kill()
+        process.wait()
+    if process.returncode:
+        error_and_exit(
+            "BATCH_PROCESS_ERROR",
+            subprocess.CalledProcessError(process.returncode, process.args).__str__()
+        )
+
+
+batch: Iterator[dict] | list
+if toml_data.batch.format == "ndjson":
+    batch = stream_batch()
+else:
+    batch = load_batch()
 
 session = requests.Session()
+# Size the pool to the worker count unless the adapter sets it, so concurrent rows don't queue for a connection.
+http_adapter = HTTPAdapter(
+    pool_connections=adapter_data.pool_connections,
+    pool_maxsize=adapter_data.pool_maxsize or flag_concurrency,
+    # Only failing to connect is retried here, a read timeout is left to `--retries`.
+    max_retries=urllib3.util.Retry(total=adapter_data.max_retries, read=False),
+    pool_block=adapter_data.pool_block
+)
+session.mount("http://", http_adapter)
+session.mount("https://", http_adapter)
+
+if not adapter_data.verify:
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 console = Console()
 
-for pos in range(len(batch)):
 
-    piper = Piper({"batch": batch[pos]})
+def compress_payload(payload: str) -> str | bytes:
+    match toml_data.http.compress:
+        case "gzip":
+            return gzip.compress(payload.encode("utf-8"))
+        case "zstd":
+            try:
+                import zstandard
+            except ImportError as e:
+                error_and_exit("COMPRESS_ERROR", f"compress = \"zstd\" needs the zstandard package: {e}")
+            return zstandard.ZstdCompressor().compress(payload.encode("utf-8"))
+    return payload
+
+
+def prepare_row(row: dict) -> tuple[str, requests.PreparedRequest]:
+    piper = Piper({"batch": row})
 
     payload = ""
-    if toml_data.http.method not in ["GET", "HEAD", "CONNECT", "TRACE", "OPTIONS"] and toml_data.http.payload:
-        if type(toml_data.http.payload) is str:
-            payload = xmltodict.parse(toml_data.http.payload)
-            payload = xmltodict.unparse(piper.process(payload), pretty=True)
-        else:
-            payload = xmltodict.unparse(piper.process(toml_data.http.payload), pretty=True)
+    if payload_template:
+        payload = piper.process(payload_template)
+
+    # Whatever urllib3 can decode, br and zstd included when their packages are installed.
+    headers = (
+        {"Accept-Encoding": requests.utils.DEFAULT_ACCEPT_ENCODING}
+        | piper.process(headers_template)
+        | adapter_data.headers
+    )
+    if payload and toml_data.http.compress:
+        headers["Content-Encoding"] = toml_data.http.compress
 
     req = requests.Request(
         method=toml_data.http.method,
         url=adapter_data.url.rstrip("/") + "/" + process_endpoint_arg(piper),
-        headers=piper.process(toml_data.http.headers) | adapter_data.headers,
-        params=piper.process(toml_data.http.params),
-        cookies=piper.process(toml_data.http.cookies),
-        data=payload
+        headers=headers,
+        params=piper.process(params_template),
+        cookies=piper.process(cookies_template),
+        data=compress_payload(payload) if payload else payload
     )
 
-    prepared_req = req.prepare()
+    return payload, req.prepare()
+
+
+@dataclass(frozen=True)
+class RowResult():
+    pos: int
+    row: dict
+    payload: str = ""
+    res: requests.Response | httpx.Response | None = None
+    error: Exception | None = None
+    latency: float = 0.0
 
-    if not adapter_data.verify:
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-    res: requests.Response | None = None
+def backoff_seconds(attempt: int) -> float:
+    return flag_backoff * (2 ** attempt) + random.uniform(0, flag_backoff)
+
+
+def send_row(pos: int, row: dict) -> RowResult:
+    payload, prepared_req = prepare_row(row)
+    if not adapter_data.keep_alive:
+        prepared_req.headers["Connection"] = "close"
+    for attempt in range(flag_retries + 1):
+        start = time.perf_counter()
+        try:
+            res = session.send(prepared_req, verify=adapter_data.verify, timeout=adapter_data.timeout())
+            return RowResult(pos, row, payload, res=res, latency=time.perf_counter() - start)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == flag_retries:
+                return RowResult(pos, row, payload, error=e)
+            time.sleep(backoff_seconds(attempt))
+
+
+def retry_after_seconds(res: requests.Response | httpx.Response) -> float:
+    value = res.headers.get("Retry-After", "").strip()
+    if not value:
+        return 0.0
+    if value.isdigit():
+        return float(value)
     try:
-        res = session.send(prepared_req, verify=adapter_data.verify)
-    except requests.ConnectionError as e:
-        error_and_exit("REQUESTS_CONNECTION_ERROR", e.__str__())
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class ConcurrencyController:
+    """Additive-increase/multiplicative-decrease limit on rows in flight, used with `--concurrency auto`.
+
+    The limit doubles per round trip until the first sign of overload, then grows by one per round trip.
+    A 429, 503 or other 5xx, a failed connection, or a latency well above the best seen so far,
+    halves it at most once per round trip.
+    """
+    __limit: float
+    __slow_start: bool
+    __baseline: float | None
+    __last_decrease: float
+    __paused_until: float
+
+    def __init__(self):
+        self.__limit = 1.0 if flag_adaptive else float(flag_concurrency)
+        self.__slow_start = True
+        self.__baseline = None
+        self.__last_decrease = 0.0
+        self.__paused_until = 0.0
+
+    @property
+    def limit(self) -> int:
+        return max(int(self.__limit), 1)
+
+    def pause(self) -> float:
+        return max(self.__paused_until - time.monotonic(), 0.0)
+
+    def record(self, result: RowResult):
+        if not flag_adaptive:
+            return
+        now = time.monotonic()
+        res = result.res
+        if res is None:
+            self.__decrease(now, self.__baseline or 0.0)
+            return
+
+        latency = res.elapsed.total_seconds()
+        if self.__baseline is None or latency < self.__baseline:
+            self.__baseline = latency
+        else:
+            # Let the baseline drift up slowly, so a server that got slower for good isn't penalised forever.
+            self.__baseline += (latency - self.__baseline) * 0.01
+
+        if res.status_code in (429, 503):
+            self.__paused_until = max(self.__paused_until, now + retry_after_seconds(res))
+
+        overloaded = res.status_code == 429 or res.status_code >= 500
+        congested = latency > max(self.__baseline * 2, self.__baseline + 0.1)
+        if overloaded or congested:
+            self.__decrease(now, latency)
+        elif self.__slow_start:
+            self.__limit = min(self.__limit + 1, flag_concurrency)
+        else:
+            self.__limit = min(self.__limit + 1 / self.__limit, flag_concurrency)
+
+    def __decrease(self, now: float, latency: float):
+        if now - self.__last_decrease < latency:
+            return
+        self.__limit = max(self.__limit / 2, 1.0)
+        self.__slow_start = False
+        self.__last_decrease = now
+
+
+controller = ConcurrencyController()
+
+
+def failed_status(res: requests.Response | httpx.Response) -> bool:
+    """A 429 or 5xx, the server didn't handle the row and it isn't complete."""
+    return res.status_code == 429 or res.status_code >= 500
+
+
+class RetryQueue:
+    """Rows answered with a 429 or 503, sent again once their `Retry-After` has passed, up to `--retries` times.
+
+    Without a `Retry-After` a row waits `--backoff` seconds doubled on each attempt, like a failed connection.
+    """
+    __due: list[tuple[float, int, dict]]
+    __attempts: dict[int, int]
+
+    def __init__(self):
+        self.__due = []
+        self.__attempts = {}
+
+    def __len__(self) -> int:
+        return len(self.__due)
+
+    def push(self, result: RowResult) -> bool:
+        """Queue the row again if it was throttled and has retries left, the result is dropped then."""
+        if result.res is None or result.res.status_code not in (429, 503):
+            self.__attempts.pop(result.pos, None)
+            return False
+        attempt = self.__attempts.get(result.pos, 0)
+        if attempt >= flag_retries:
+            self.__attempts.pop(result.pos, None)
+            return False
+        self.__attempts[result.pos] = attempt + 1
+        delay = retry_after_seconds(result.res) or backoff_seconds(attempt)
+        heapq.heappush(self.__due, (time.monotonic() + delay, result.pos, result.row))
+        return True
+
+    def pop(self) -> tuple[int, dict] | None:
+        if not self.__due or self.__due[0][0] > time.monotonic():
+            return None
+        _, pos, row = heapq.heappop(self.__due)
+        return pos, row
+
+    def wait(self) -> float:
+        """Seconds until something can be sent again, after a pause or once the next retry is due."""
+        pause = controller.pause()
+        if pause or not self.__due:
+            return pause
+        return max(self.__due[0][0] - time.monotonic(), 0.0)
+
+
+class Checkpoint:
+    """Indexes of completed rows, one per line, appended as each row completes."""
+    __done: set[int]
+
+    def __init__(self, path: str, resume: bool):
+        self.__done = set()
+        if resume and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.__done = {int(line) for line in f if line.strip()}
+            except ValueError as e:
+                error_and_exit("CHECKPOINT_ERROR", e.__str__())
+        self.__file = open(path, "a" if resume else "w")
+
+    def __contains__(self, pos: int) -> bool:
+        return pos in self.__done
+
+    def add(self, pos: int):
+        self.__file.write(f"{pos}\n")
+        # Flush per row, the point of the file is to survive the run being killed.
+        self.__file.flush()
+
+
+checkpoint: Checkpoint | None = None
+dead_letter = None
+try:
+    if flag_checkpoint:
+        checkpoint = Checkpoint(flag_checkpoint, flag_resume)
+    if flag_dead_letter:
+        dead_letter = open(flag_dead_letter, "a" if flag_resume else "w")
+except OSError as e:
+    error_and_exit("OS_ERROR", e.__str__())
+
+
+def error_name(e: Exception) -> str:
+    if isinstance(e, httpx.TimeoutException):
+        return "HTTPX_TIMEOUT_ERROR"
+    if isinstance(e, httpx.TransportError):
+        return "HTTPX_TRANSPORT_ERROR"
+    if isinstance(e, requests.Timeout):
+        return "REQUESTS_TIMEOUT_ERROR"
+    return "REQUESTS_CONNECTION_ERROR"
+
+
+class LatencyHistogram:
+    """HDR-style histogram of latencies in microseconds.
+
+    Values keep their top 8 bits, so any recorded value is off by less than 1%, whatever its magnitude,
+    and memory only grows with the number of distinct buckets hit.
+    """
+    __counts: dict[int, int]
+    count: int
+    total: int
+    min: int
+    max: int
+
+    def __init__(self):
+        self.__counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def record(self, seconds: float):
+        value = max(int(seconds * 1_000_000), 0)
+        index = self.__index(value)
+        self.__counts[index] = self.__counts.get(index, 0) + 1
+        self.min = value if not self.count else min(self.min, value)
+        self.max = max(self.max, value)
+        self.count += 1
+        self.total += value
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent: float) -> int:
+        if not self.count:
+            return 0
+        rank = max(math.ceil(self.count * percent / 100), 1)
+        seen = 0
+        for index in sorted(self.__counts):
+            seen += self.__counts[index]
+            if seen >= rank:
+                return min(self.__highest(index), self.max)
+        return self.max
+
+    @staticmethod
+    def __index(value: int) -> int:
+        if value < 256:
+            return value
+        shift = value.bit_length() - 8
+        return (shift << 8) | (value >> shift)
+
+    @staticmethod
+    def __highest(index: int) -> int:
+        shift = index >> 8
+        return (((index & 255) + 1) << shift) - 1
+
+
+def body_size(body: str | bytes | None) -> int:
+    if body is None:
+        return 0
+    return len(body.encode("utf-8") if type(body) is str else body)
+
+
+def received_size(res: requests.Response) -> int | None:
+    # urllib3 does not count chunked bodies, without a Content-Encoding they are as long as decoded.
+    if res.raw.chunked:
+        return None if "Content-Encoding" in res.headers else len(res.content)
+    return res.raw.tell()
+
+
+def transfer_size(result: RowResult) -> dict:
+    """Bytes on the wire next to the bytes they decode to, for the payload sent and the body received."""
+    res = result.res
+    if type(res) is httpx.Response:
+        sent, received = len(res.request.content), res.num_bytes_downloaded
+    else:
+        sent, received = body_size(res.request.body), received_size(res)
+    return {
+        "request": {"wire": sent, "decoded": body_size(result.payload)},
+        "response": {"wire": received, "decoded": len(res.content)}
+    }
+
+
+class RunStats:
+    """Counts and latency of the rows handled in this run, printed as the summary at the end."""
+    histogram: LatencyHistogram
+    status: dict[str, int]
+    errors: dict[str, int]
+    size: dict[str, dict[str, int]]
+
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        self.status = {}
+        self.errors = {}
+        self.size = {"request": {"wire": 0, "decoded": 0}, "response": {"wire": 0, "decoded": 0}}
+        self.__start = time.perf_counter()
+
+    def record(self, result: RowResult):
+        if result.error:
+            name = error_name(result.error)
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return
+        status_class = f"{result.res.status_code // 100}xx"
+        self.status[status_class] = self.status.get(status_class, 0) + 1
+        self.histogram.record(result.latency)
+        for direction, size in transfer_size(result).items():
+            for key, value in size.items():
+                self.size[direction][key] += value or 0
+
+    def rows(self) -> int:
+        return self.histogram.count + sum(self.errors.values())
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.__start
+
+    def print(self, file=sys.stdout):
+        elapsed = self.elapsed()
+        histogram = self.histogram
+        print("-- Summary --", file=file)
+        print(f"Rows: {self.rows()}", file=file)
+        print(f"Status: {", ".join(f"{key}={value}" for key, value in sorted(self.status.items())) or "-"}", file=file)
+        print(f"Errors: {", ".join(f"{key}={value}" for key, value in sorted(self.errors.items())) or "-"}", file=file)
+        print(f"Elapsed: {timedelta(seconds=elapsed)}", file=file)
+        print(f"Throughput: {self.rows() / elapsed if elapsed else 0.0:.2f} req/s", file=file)
+        print(
+            f"Bytes: sent={self.size["request"]["wire"]} (decoded {self.size["request"]["decoded"]})"
+            f" received={self.size["response"]["wire"]} (decoded {self.size["response"]["decoded"]})",
+            file=file
+        )
+        print(
+            f"Latency (ms): min={histogram.min / 1000:.2f} mean={histogram.mean() / 1000:.2f}"
+            f" p50={histogram.percentile(50) / 1000:.2f} p90={histogram.percentile(90) / 1000:.2f}"
+            f" p99={histogram.percentile(99) / 1000:.2f} max={histogram.max / 1000:.2f}",
+            file=file
+        )
 
-    print(f"-- Batch: {pos + 1} --")
 
+stats = RunStats()
+
+latency_csv = None
+if flag_latency_csv:
+    try:
+        latency_csv = csv.writer(open(flag_latency_csv, "w", newline=""))
+        latency_csv.writerow(["pos", "status", "latency_ms"])
+    except OSError as e:
+        error_and_exit("OS_ERROR", e.__str__())
+
+
+def pending_rows() -> Iterator[tuple[int, dict]]:
+    for pos, row in enumerate(batch):
+        if checkpoint and pos in checkpoint:
+            continue
+        yield pos, row
+
+
+class ResultOrder:
+    """Hands finished rows back in the order they were sent, or as they finish with `--unordered`."""
+    __sent: deque[int]
+    __finished: dict[int, RowResult]
+
+    def __init__(self):
+        self.__sent = deque()
+        self.__finished = {}
+
+    def __len__(self) -> int:
+        return len(self.__finished)
+
+    def sent(self, pos: int):
+        if not flag_unordered:
+            self.__sent.append(pos)
+
+    def push(self, result: RowResult) -> Iterator[RowResult]:
+        if flag_unordered:
+            yield result
+            return
+        self.__finished[result.pos] = result
+        while self.__sent and self.__sent[0] in self.__finished:
+            yield self.__finished.pop(self.__sent.popleft())
+
+
+def can_submit(in_flight: int, order: ResultOrder) -> bool:
+    # Cap the reorder buffer too, so one slow row can't make the rest pile up in memory.
+    return in_flight < controller.limit and len(order) < flag_concurrency * 4
+
+
+def dispatch_rows() -> Iterator[RowResult]:
+    if flag_concurrency == 1 and not flag_adaptive:
+        retries = RetryQueue()
+        for pos, row in pending_rows():
+            result = send_row(pos, row)
+            while retries.push(result):
+                while not (due := retries.pop()):
+                    time.sleep(retries.wait())
+                result = send_row(*due)
+            yield result
+        return
+
+    rows = pending_rows()
+    in_flight: set[Future] = set()
+    order = ResultOrder()
+    retries = RetryQueue()
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=flag_concurrency) as executor:
+        while True:
+            # Throttled rows go first and skip the reorder cap, the rows held back may be waiting on them.
+            while not controller.pause() and len(in_flight) < controller.limit and (due := retries.pop()):
+                in_flight.add(executor.submit(send_row, *due))
+            while not exhausted and not controller.pause() and can_submit(len(in_flight), order):
+                try:
+                    pos, row = next(rows)
+                except StopIteration:
+                    exhausted = True
+                    break
+                order.sent(pos)
+                in_flight.add(executor.submit(send_row, pos, row))
+            if not in_flight:
+                if exhausted and not retries:
+                    break
+                time.sleep(retries.wait())
+                continue
+            done, in_flight = wait(in_flight, timeout=retries.wait() or None, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                controller.record(result)
+                if not retries.push(result):
+                    yield from order.push(result)
+
+
+async def send_row_async(client: httpx.AsyncClient, pos: int, row: dict) -> RowResult:
+    payload, prepared_req = prepare_row(row)
+    for attempt in range(flag_retries + 1):
+        start = time.perf_counter()
+        try:
+            res = await client.request(
+                prepared_req.method,
+                prepared_req.url,
+                headers=dict(prepared_req.headers),
+                content=prepared_req.body
+            )
+            return RowResult(pos, row, payload, res=res, latency=time.perf_counter() - start)
+        except httpx.TransportError as e:
+            if attempt == flag_retries:
+                return RowResult(pos, row, payload, error=e)
+            await asyncio.sleep(backoff_seconds(attempt))
+
+
+async def dispatch_rows_async() -> AsyncIterator[RowResult]:
+    # A single client multiplexes every in-flight row over HTTP/2 when the server negotiates it.
+    pool_maxsize = adapter_data.pool_maxsize or flag_concurrency
+    limits = httpx.Limits(
+        max_connections=pool_maxsize,
+        max_keepalive_connections=pool_maxsize if adapter_data.keep_alive else 0
+    )
+    timeout = httpx.Timeout(None, connect=adapter_data.connect_timeout, read=adapter_data.read_timeout)
+    # Retries at the transport only cover failing to connect, like `max_retries` on the requests side.
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        verify=adapter_data.verify,
+        limits=limits,
+        retries=adapter_data.max_retries
+    )
+    async with httpx.AsyncClient(transport=transport, timeout=timeout) as client:
+        rows = pending_rows()
+        in_flight: set[asyncio.Task] = set()
+        order = ResultOrder()
+        retries = RetryQueue()
+        exhausted = False
+        while True:
+            while not controller.pause() and len(in_flight) < controller.limit and (due := retries.pop()):
+                in_flight.add(asyncio.create_task(send_row_async(client, *due)))
+            while not exhausted and not controller.pause() and can_submit(len(in_flight), order):
+                try:
+                    pos, row = next(rows)
+                except StopIteration:
+                    exhausted = True
+                    break
+                order.sent(pos)
+                in_flight.add(asyncio.create_task(send_row_async(client, pos, row)))
+            if not in_flight:
+                if exhausted and not retries:
+                    break
+                await asyncio.sleep(retries.wait())
+                continue
+            done, in_flight = await asyncio.wait(
+                in_flight,
+                timeout=retries.wait() or None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                controller.record(task.result())
+                if retries.push(task.result()):
+                    continue
+                for result in order.push(task.result()):
+                    yield result
+
+
+def print_row(result: RowResult):
+    print(f"-- Batch: {result.pos + 1} --")
+
+    if result.error:
+        print("-- Error --")
+        print(f"{error_name(result.error)}: {result.error}")
+        return
+
+    res = result.res
     if flag_show_request:
         print("-- Request Headers --")
         pprint(dict(res.request.headers), expand_all=True)
         print("-- Request Payload --")
-        console.print(Syntax(payload, "xml", background_color="black"))
+        console.print(Syntax(result.payload, "xml", background_color="black"))
 
     print("-- Response --")
     print(f"URL: {res.request.url}")
     print(f"Status: {res.status_code}")
     print(f"Elapsed: {res.elapsed}")
+    if flag_adaptive:
+        print(f"Concurrency: {controller.limit}")
     print("-- Response Body --")
 
     if not res.text:
-        continue
+        return
     try:
         xml_res = xmltodict.parse(res.text)
         console.print(Syntax(xmltodict.unparse(xml_res, pretty=True), "xml", background_color="black"))
     except ExpatError:
-        continue
+        return
+
+
+def pipe_record(result: RowResult) -> dict:
+    if result.error:
+        return {
+            "edition": "xml",
+            "pos": result.pos,
+            "error": {"name": error_name(result.error), "message": result.error.__str__()}
+        }
+    res = result.res
+    try:
+        body = xmltodict.parse(res.text) if res.text else {}
+    except ExpatError:
+        # Not XML, such as an error page, kept as text like the json runner does.
+        body = res.text
+    return {
+        "edition": "xml",
+        "pos": result.pos,
+        "request": {
+            "headers": dict(res.request.headers),
+            "payload": xmltodict.parse(result.payload) if result.payload else {},
+            "payload_original": result.payload
+            },
+        "url": f"{res.request.url}",
+        "method": res.request.method,
+        "status": res.status_code,
+        "headers": dict(res.headers),
+        "cookies": dict(res.cookies),
+        "body": body,
+        # As sent by the server, re-indenting every row would cost a second parse.
+        "body_original": res.text,
+        "elapsed": f"{res.elapsed}",
+        "size": transfer_size(result)
+    }
+
+
+def write_dead_letter(result: RowResult, name: str, message: str):
+    json.dump({"pos": result.pos, "row": result.row, "name": name, "message": message}, dead_letter)
+    dead_letter.write("\n")
+    dead_letter.flush()
+
+
+def handle_result(result: RowResult):
+    if result.error:
+        if not dead_letter:
+            raise result.error
+        write_dead_letter(result, error_name(result.error), result.error.__str__())
+    elif failed_status(result.res):
+        # Not checkpointed, so `--resume` sends it again.
+        if dead_letter:
+            write_dead_letter(result, "HTTP_STATUS_ERROR", f"{result.res.request.url} answered {result.res.status_code}")
+    elif checkpoint:
+        checkpoint.add(result.pos)
+    stats.record(result)
+    if latency_csv:
+        status = error_name(result.error) if result.error else result.res.status_code
+        latency_csv.writerow([result.pos, status, f"{result.latency * 1000:.3f}"])
+    if flag_pipe:
+        sys.stdout.write(json.dumps(pipe_record(result)) + "\n")
+        return
+    print_row(result)
+
+
+async def run_async():
+    async for result in dispatch_rows_async():
+        handle_result(result)
+
+
+try:
+    if flag_engine == "async":
+        asyncio.run(run_async())
+    else:
+        for result in dispatch_rows():
+            handle_result(result)
+except requests.ConnectionError as e:
+    error_and_exit("REQUESTS_CONNECTION_ERROR", e.__str__())
+except requests.Timeout as e:
+    error_and_exit("REQUESTS_TIMEOUT_ERROR", e.__str__())
+except httpx.TimeoutException as e:
+    error_and_exit("HTTPX_TIMEOUT_ERROR", e.__str__())
+except httpx.TransportError as e:
+    error_and_exit("HTTPX_TRANSPORT_ERROR", e.__str__())
+
+# Under `--pipe` stdout carries the records, the summary goes to stderr.
+stats.print(sys.stderr if flag_pipe else sys.stdout)